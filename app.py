@@ -1,15 +1,24 @@
+import time
+_import_t0 = time.perf_counter()
 import streamlit as st
 import yfinance as yf
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
-from FinMind.data import DataLoader
 from datetime import datetime, timedelta
 import json
 import os
-from openai import OpenAI
 import re
+# openai / FinMind / plotly.express / plotly.subplots 於第一次用到的面板才載入，不拖慢啟動
+import sqlite3
+import threading
+import functools
+import hashlib
+import inspect
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+_import_seconds = time.perf_counter() - _import_t0
 
 # --- 1. 系統初始化 ---
 st.set_page_config(page_title="全球股權資訊對比助手", layout="wide")
@@ -62,14 +71,195 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-api = DataLoader()
+# [效能量測] 全程序共用的計時區段、上游呼叫次數與快取命中統計；可匯出 Prometheus 文字格式或 JSON lines
+METRICS_JSONL = os.environ.get("METRICS_JSONL", "")  # 每次重跑附加一行
+METRICS_PROM = os.environ.get("METRICS_PROM", "")    # 供 node_exporter textfile collector 讀取
+METRICS_WINDOW = 2000  # 每個區段保留最近幾筆計算分位數
+
+class Metrics:
+    def __init__(self, window):
+        self.lock = threading.Lock()
+        self.samples = {}   # 區段 -> 最近 window 筆耗時
+        self.totals = {}    # 區段 -> [次數, 總秒數]
+        self.counters = {}  # (指標, 標籤) -> 次數
+        self.window = window
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += 1; total[1] += seconds
+
+    @contextmanager
+    def span(self, name):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - t0)
+
+    def count(self, metric, label, n=1):
+        with self.lock:
+            self.counters[(metric, label)] = self.counters.get((metric, label), 0) + n
+
+    def span_table(self):
+        with self.lock:
+            rows = [(name, self.totals[name][0], *np.percentile(list(vals), [50, 95]), max(vals)) for name, vals in self.samples.items()]
+        return pd.DataFrame(rows, columns=["區段", "次數", "p50 (s)", "p95 (s)", "max (s)"]).sort_values("區段")
+
+    def cache_table(self):
+        with self.lock:
+            lookups = {label: n for (metric, label), n in self.counters.items() if metric == "cache_lookups"}
+            misses = {label: n for (metric, label), n in self.counters.items() if metric == "cache_misses"}
+        df = pd.DataFrame({"查詢": pd.Series(lookups, dtype=float), "未命中": pd.Series(misses, dtype=float)}).fillna(0)
+        df["命中率"] = 1 - df["未命中"] / df["查詢"].where(df["查詢"] > 0)
+        return df
+
+    def upstream_counts(self):
+        with self.lock:
+            return {label: n for (metric, label), n in self.counters.items() if metric == "upstream_calls"}
+
+    def to_prometheus(self):
+        out = ["# TYPE app_span_seconds summary"]
+        with self.lock:
+            for name, vals in sorted(self.samples.items()):
+                for q, v in zip((0.5, 0.95, 0.99), np.percentile(list(vals), [50, 95, 99])):
+                    out.append(f'app_span_seconds{{span="{name}",quantile="{q}"}} {v:.6f}')
+                out.append(f'app_span_seconds_count{{span="{name}"}} {self.totals[name][0]}')
+                out.append(f'app_span_seconds_sum{{span="{name}"}} {self.totals[name][1]:.6f}')
+            for metric in sorted({m for m, _ in self.counters}):
+                label_key = "service" if metric == "upstream_calls" else "cache"
+                out.append(f"# TYPE app_{metric}_total counter")
+                for (m, label), n in sorted(self.counters.items()):
+                    if m == metric: out.append(f'app_{metric}_total{{{label_key}="{label}"}} {n}')
+        return "\n".join(out) + "\n"
+
+@st.cache_resource
+def get_metrics():
+    return Metrics(METRICS_WINDOW)
+
+def count_upstream(service):
+    get_metrics().count("upstream_calls", service)
+
+# [共用資料快取] 全程序一份唯讀 DataFrame，各 session 拿到 copy-on-write 淺複本 (不複製資料)，依 LRU 在記憶體上限內淘汰
+pd.set_option("mode.copy_on_write", True)  # 呼叫端新增/修改欄位時才複製被改動的部分，不會寫回共用的那一份
+FRAME_CACHE_MB = float(os.environ.get("FRAME_CACHE_MB", 512))
+
+def compact_frame(df, float32=False, categorical=()):
+    """精簡欄位型別：指定的文字欄轉 category；float32=True 時除成交量外的 float64 欄轉 float32 (財報金額保留 float64 以免失真)"""
+    if not isinstance(df, pd.DataFrame) or df.empty: return df
+    df = df.copy(deep=False)
+    for c in df.columns:
+        if c in categorical: df[c] = df[c].astype("category")
+        elif float32 and c != 'Volume' and df[c].dtype == np.float64: df[c] = df[c].astype(np.float32)
+    return df
+
+class FrameCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (frame, 位元組, 到期時間)；越後面越近期使用
+        self.key_locks = {}           # key -> Lock，同一鍵同時未命中只計算一次
+        self.bytes = 0
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None: return None
+        if entry[2] < time.time():
+            self.bytes -= self.entries.pop(key)[1]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key, frame, ttl):
+        size = int(frame.memory_usage(index=True, deep=True).sum()) if isinstance(frame, pd.DataFrame) else 0
+        with self.lock:
+            if key in self.entries: self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (frame, size, time.time() + ttl if ttl else float("inf"))
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, (_, old_size, _) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                get_metrics().count("cache_evictions", old_key[0])
+
+    def get(self, name, key, ttl, compute):
+        key = (name, *key)
+        with self.lock:
+            frame = self._lookup(key)
+            if frame is None: key_lock = self.key_locks.setdefault(key, threading.Lock())
+        if frame is None:
+            with key_lock:
+                try:
+                    with self.lock: frame = self._lookup(key)
+                    if frame is None:
+                        get_metrics().count("cache_misses", name)
+                        frame = compute()
+                        self._put(key, frame, ttl)
+                finally:
+                    with self.lock: self.key_locks.pop(key, None)
+        return frame.copy(deep=False) if isinstance(frame, pd.DataFrame) else frame
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "MB": round(self.bytes / 2 ** 20, 1), "cap_MB": round(self.max_bytes / 2 ** 20, 1)}
+
+    def clear(self, name=None):
+        with self.lock:
+            for key in [k for k in self.entries if name is None or k[0] == name]:
+                self.bytes -= self.entries.pop(key)[1]
+
+@st.cache_resource
+def get_frame_cache():
+    return FrameCache(FRAME_CACHE_MB * 2 ** 20)
+
+def tracked_cache_frame(name, ttl=None, float32=False, categorical=()):
+    """以共用資料快取取代 st.cache_data (後者每次命中都反序列化出一份新副本)，並記錄命中率與耗時"""
+    def deco(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def lookup(*args, **kw):
+            metrics = get_metrics()
+            metrics.count("cache_lookups", name)
+            # 以綁定並補上預設值後的參數為鍵：f(a, b) 與 f(a, b, ()) 或 f(a, b=b) 共用同一筆
+            bound = sig.bind(*args, **kw)
+            bound.apply_defaults()
+            with metrics.span(f"fetch.{name}"):
+                return get_frame_cache().get(name, tuple(bound.arguments.items()), ttl,
+                                             lambda: compact_frame(fn(*bound.args, **bound.kwargs), float32, categorical))
+        lookup.clear = lambda: get_frame_cache().clear(name)
+        return lookup
+    return deco
+
+def export_metrics(perf):
+    if METRICS_JSONL:
+        with open(METRICS_JSONL, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.time(), **perf}) + "\n")
+    if METRICS_PROM:
+        with open(METRICS_PROM + ".tmp", "w", encoding="utf-8") as f: f.write(get_metrics().to_prometheus())
+        os.replace(METRICS_PROM + ".tmp", METRICS_PROM)
+
+# 本次執行各面板耗時記於 st.session_state.perf (bench.py 亦讀取此處)
+_rerun_t0 = time.perf_counter()
+st.session_state.perf = {"imports": _import_seconds}  # 同一程序的後續重跑模組已載入，接近 0
+
+@contextmanager
+def perf_span(name):
+    t0 = time.perf_counter()
+    try: yield
+    finally:
+        st.session_state.perf[name] = time.perf_counter() - t0
+        get_metrics().observe(f"panel.{name}", st.session_state.perf[name])
+
 DB_FILE = "portfolio_db.json"
+MARKET_DB = os.environ.get("MARKET_DB", "market_data.db")
 
 # 標準科目權重
 US_STD_ORDER = {
     "Total Revenue": 10, "Cost of Revenue": 20, "Gross Profit": 30, "Operating Expense": 40,
     "Operating Income": 50, "Net Income": 90, "Basic EPS": 100
 }
+# FinMind 台股科目 -> 標準科目
+TW_US_ITEMS = {"Revenue": "Total Revenue", "CostOfGoodsSold": "Cost of Revenue", "GrossProfit": "Gross Profit", "OperatingExpenses": "Operating Expense",
+               "OperatingIncome": "Operating Income", "NetIncome": "Net Income", "EPS": "Basic EPS"}
 
 # yfinance 現成比率
 YF_RATIOS = {
@@ -93,35 +283,577 @@ YF_RATIOS = {
 }
 PERCENTAGE_FIELDS = ["profitMargins", "grossMargins", "operatingMargins", "returnOnAssets", "returnOnEquity", "dividendYield", "payoutRatio"]
 
-# 資料庫讀取
-if 'db' not in st.session_state:
-    if os.path.exists(DB_FILE):
+# [投資組合資料庫] SQLite (WAL)：逐列寫入、原子提交，多 session 以版本號同步
+PORTFOLIO_DB = os.environ.get("PORTFOLIO_DB", "portfolio.db")
+DEFAULT_DB = {"watchlists": {"權值股": ["2330", "TSLA"]}, "custom_ratios": {}}
+
+class PortfolioStore:
+    def __init__(self, path, legacy_json):
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS folders (name TEXT PRIMARY KEY, position INTEGER);
+            CREATE TABLE IF NOT EXISTS folder_items (folder TEXT, ticker TEXT, position INTEGER, PRIMARY KEY (folder, ticker));
+            CREATE TABLE IF NOT EXISTS custom_ratios (name TEXT PRIMARY KEY, formula TEXT, position INTEGER);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        """)
+        with self.lock, self.conn:
+            # 先寫入遷移旗標取得寫入鎖，匯入與旗標同一交易提交；並行啟動時只有搶到旗標者匯入
+            if self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('migrated', 1)").rowcount:
+                self._import(self._load_legacy(legacy_json))
+
+    @staticmethod
+    def _load_legacy(path):
+        """一次性匯入舊版 JSON；相容最上層即為資料夾字典的舊格式"""
+        if not os.path.exists(path): return DEFAULT_DB
         try:
-            with open(DB_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 temp_db = json.load(f)
-                if "watchlists" not in temp_db:
-                    temp_db = {"watchlists": temp_db, "custom_ratios": {}}
-                if "custom_ratios" not in temp_db:
-                    temp_db["custom_ratios"] = {}
-                st.session_state.db = temp_db
+            if "watchlists" not in temp_db:
+                temp_db = {"watchlists": temp_db, "custom_ratios": {}}
+            temp_db.setdefault("custom_ratios", {})
+            return temp_db
         except:
-            st.session_state.db = {"watchlists": {"權值股": ["2330", "TSLA"]}, "custom_ratios": {}}
-    else:
-        st.session_state.db = {"watchlists": {"權值股": ["2330", "TSLA"]}, "custom_ratios": {}}
+            return DEFAULT_DB
+
+    def _import(self, data):
+        for i, (fn, tickers) in enumerate(data["watchlists"].items()):
+            self.conn.execute("INSERT OR IGNORE INTO folders VALUES (?,?)", (fn, i))
+            self.conn.executemany("INSERT OR IGNORE INTO folder_items VALUES (?,?,?)", [(fn, t, j) for j, t in enumerate(tickers)])
+        self.conn.executemany("INSERT OR REPLACE INTO custom_ratios VALUES (?,?,?)", [(k, v, i) for i, (k, v) in enumerate(data["custom_ratios"].items())])
+
+    def _write(self, *statements):
+        with self.lock, self.conn:
+            for sql, params in statements: self.conn.execute(sql, params)
+            self.conn.execute("INSERT INTO meta VALUES ('version', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1")
+        for fn in list(self.listeners): fn()
+
+    def subscribe(self, fn):
+        self.listeners.append(fn)
+
+    def version(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+        return row[0] if row else 0
+
+    def snapshot(self):
+        with self.lock:
+            version = self.conn.execute("SELECT COALESCE((SELECT value FROM meta WHERE key='version'), 0)").fetchone()[0]
+            watchlists = {fn: [] for (fn,) in self.conn.execute("SELECT name FROM folders ORDER BY position")}
+            for fn, t in self.conn.execute("SELECT folder, ticker FROM folder_items ORDER BY position"):
+                if fn in watchlists: watchlists[fn].append(t)
+            ratios = dict(self.conn.execute("SELECT name, formula FROM custom_ratios ORDER BY position"))
+        return version, {"watchlists": watchlists, "custom_ratios": ratios}
+
+    def add_folder(self, name):
+        self._write(("INSERT OR IGNORE INTO folders VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM folders))", (name,)))
+
+    def delete_folder(self, name):
+        self._write(("DELETE FROM folder_items WHERE folder=?", (name,)), ("DELETE FROM folders WHERE name=?", (name,)))
+
+    def add_ticker(self, folder, ticker):
+        self._write(("INSERT OR IGNORE INTO folder_items VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM folder_items WHERE folder=?))", (folder, ticker, folder)))
+
+    def remove_ticker(self, folder, ticker):
+        self._write(("DELETE FROM folder_items WHERE folder=? AND ticker=?", (folder, ticker)))
+
+    def save_ratio(self, name, formula):
+        self._write(("INSERT INTO custom_ratios VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM custom_ratios)) ON CONFLICT(name) DO UPDATE SET formula=excluded.formula", (name, formula)))
+
+@st.cache_resource
+def get_portfolio_store():
+    return PortfolioStore(PORTFOLIO_DB, DB_FILE)
+
+portfolio = get_portfolio_store()
+
+def sync_portfolio():
+    """資料庫讀取：其他 session 有寫入時 (版本號變動) 才重新載入。片段重跑不經過此處，寫入後需自行呼叫。"""
+    if st.session_state.get('db_version') != portfolio.version():
+        st.session_state.db_version, st.session_state.db = portfolio.snapshot()
+
+sync_portfolio()
 
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 if 'active_folder' not in st.session_state: st.session_state.active_folder = None
+if st.session_state.active_folder not in st.session_state.db["watchlists"]: st.session_state.active_folder = None
 if 'formula_buffer' not in st.session_state: st.session_state.formula_buffer = ""
 
-def save_db():
-    with open(DB_FILE, "w", encoding="utf-8") as f:
-        json.dump(st.session_state.db, f, ensure_ascii=False, indent=4)
-
 # --- 2. 核心數據引擎 ---
 
-@st.cache_data(ttl=600)
-def get_price_data(ticker, period_label, market):
+# [本地行情倉儲] SQLite (WAL) 依 symbol + interval 分區保存 OHLCV，重啟後不必重抓
+class MarketStore:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS bars (
+                symbol TEXT, interval TEXT, ts INTEGER,
+                open REAL, high REAL, low REAL, close REAL, volume REAL,
+                PRIMARY KEY (symbol, interval, ts)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS bar_meta (
+                symbol TEXT, interval TEXT, span_days INTEGER, fetched_at REAL,
+                PRIMARY KEY (symbol, interval));
+            CREATE TABLE IF NOT EXISTS indicator_state (
+                symbol TEXT, interval TEXT, name TEXT, params TEXT, first_ts INTEGER, last_ts INTEGER, state TEXT,
+                PRIMARY KEY (symbol, interval, name));
+            CREATE TABLE IF NOT EXISTS indicator_values (
+                symbol TEXT, interval TEXT, name TEXT, ts INTEGER, value REAL,
+                PRIMARY KEY (symbol, interval, name, ts)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS fundamentals (
+                symbol TEXT, field TEXT, value REAL,
+                PRIMARY KEY (symbol, field)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS fundamental_meta (
+                symbol TEXT PRIMARY KEY, market TEXT, name TEXT, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS fm_financial (
+                stock_id TEXT, date TEXT, type TEXT, value REAL,
+                PRIMARY KEY (stock_id, date, type)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS fm_institutional (
+                stock_id TEXT, date TEXT, name TEXT, buy REAL, sell REAL,
+                PRIMARY KEY (stock_id, date, name)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS inst_agg (
+                stock_id TEXT, date TEXT, foreign_net REAL, trust_net REAL, dealer_net REAL, total_net REAL,
+                cum5 REAL, cum20 REAL, cum60 REAL, foreign_streak INTEGER, foreign_pct REAL,
+                PRIMARY KEY (stock_id, date)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS fm_coverage (
+                dataset TEXT, stock_id TEXT, first_date TEXT, last_date TEXT, checked_at REAL,
+                PRIMARY KEY (dataset, stock_id));
+        """)
+
+    def indicator_state(self, symbol, interval, name):
+        with self.lock:
+            return self.conn.execute("SELECT params, first_ts, last_ts, state FROM indicator_state WHERE symbol=? AND interval=? AND name=?", (symbol, interval, name)).fetchone()
+
+    def save_indicator(self, symbol, interval, name, params, first_ts, last_ts, state, ts, values, reset=False):
+        """寫入指標數值與已確認狀態 (最後一根K棒可能盤中變動，不納入狀態)"""
+        rows = [(symbol, interval, out, int(t), None if np.isnan(v) else float(v)) for out, vals in values.items() for t, v in zip(ts, vals)]
+        with self.lock, self.conn:
+            if reset: self.conn.execute("DELETE FROM indicator_values WHERE symbol=? AND interval=? AND name IN (%s)" % ",".join("?" * len(values)), (symbol, interval, *values))
+            self.conn.executemany("INSERT OR REPLACE INTO indicator_values VALUES (?,?,?,?,?)", rows)
+            if last_ts is not None:
+                self.conn.execute("INSERT OR REPLACE INTO indicator_state VALUES (?,?,?,?,?,?,?)", (symbol, interval, name, params, int(first_ts), int(last_ts), state))
+
+    def load_indicator_values(self, symbol, interval, outputs, since_ts):
+        df = self.query("SELECT name, ts, value FROM indicator_values WHERE symbol=? AND interval=? AND ts>=? AND name IN (%s)" % ",".join("?" * len(outputs)),
+                        (symbol, interval, int(since_ts), *outputs))
+        return df.pivot(index='ts', columns='name', values='value')
+
+    def save_fundamentals(self, symbol, market, name, fields):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM fundamentals WHERE symbol=?", (symbol,))
+            self.conn.executemany("INSERT INTO fundamentals VALUES (?,?,?)", [(symbol, k, v) for k, v in fields.items()])
+            self.conn.execute("INSERT OR REPLACE INTO fundamental_meta VALUES (?,?,?,?)", (symbol, market, name, time.time()))
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=params)
+
+    def write_rows(self, table, rows):
+        if not rows: return
+        with self.lock, self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({','.join('?' * len(rows[0]))})", rows)
+
+    def coverage(self, dataset, stock_id):
+        with self.lock:
+            return self.conn.execute("SELECT first_date, last_date, checked_at FROM fm_coverage WHERE dataset=? AND stock_id=?", (dataset, stock_id)).fetchone()
+
+    def set_coverage(self, dataset, stock_id, first_date, last_date):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO fm_coverage VALUES (?,?,?,?,?)", (dataset, stock_id, first_date, last_date, time.time()))
+
+    def bar_meta(self, symbol, interval):
+        with self.lock:
+            row = self.conn.execute("SELECT span_days, fetched_at, (SELECT MAX(ts) FROM bars WHERE symbol=? AND interval=?) FROM bar_meta WHERE symbol=? AND interval=?",
+                                    (symbol, interval, symbol, interval)).fetchone()
+        return row  # (涵蓋天數, 上次抓取時間, 最後一根K棒 ts) 或 None
+
+    def load_bars(self, symbol, interval, since_ts=0):
+        with self.lock:
+            df = pd.read_sql_query("SELECT ts, open, high, low, close, volume FROM bars WHERE symbol=? AND interval=? AND ts>=? ORDER BY ts",
+                                   self.conn, params=(symbol, interval, int(since_ts)))
+        df.index = pd.to_datetime(df.pop('ts'), unit='s', utc=True)
+        df.columns = [c.capitalize() for c in df.columns]
+        return df
+
+    def tail_bars(self, symbol, interval, n):
+        with self.lock:
+            return self.conn.execute("SELECT ts, close FROM bars WHERE symbol=? AND interval=? ORDER BY ts DESC LIMIT ?", (symbol, interval, n)).fetchall()
+
+    def replace_bars(self, symbol, interval, df, span_days):
+        """除權息等調整改寫了歷史價格：清除該分區的K棒與指標 (下次計算時整段回補) 後重寫"""
+        with self.lock, self.conn:
+            for table in ("bars", "bar_meta", "indicator_state", "indicator_values"):
+                self.conn.execute(f"DELETE FROM {table} WHERE symbol=? AND interval=?", (symbol, interval))
+        self.append_bars(symbol, interval, df, span_days)
+
+    def append_bars(self, symbol, interval, df, span_days):
+        rows = [(symbol, interval, int(ts.timestamp()), *map(float, r)) for ts, r in zip(df.index, df[['Open', 'High', 'Low', 'Close', 'Volume']].itertuples(index=False))]
+        with self.lock, self.conn:
+            # 最後一根K棒可能為盤中未完成，採 REPLACE 覆寫
+            self.conn.executemany("INSERT OR REPLACE INTO bars VALUES (?,?,?,?,?,?,?,?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO bar_meta VALUES (?,?,MAX(?, COALESCE((SELECT span_days FROM bar_meta WHERE symbol=? AND interval=?), 0)),?)",
+                              (symbol, interval, span_days, symbol, interval, time.time()))
+
+@st.cache_resource
+def get_market_store():
+    return MarketStore(MARKET_DB)
+
+PERIOD_DAYS = {"1d": 1, "5d": 5, "1mo": 31, "2y": 730, "7y": 2557}
+BAR_FRESH_SECONDS = {"1m": 60, "5m": 300, "60m": 1800, "1d": 3600}  # 期間內直接讀本地，不連網
+BAR_START_LIMIT_DAYS = {"1m": 7, "5m": 60, "60m": 730}  # yfinance 盤中資料可回溯上限
+
+def _normalize_bars(df):
+    df.columns = [c.capitalize() for c in df.columns]
+    df.dropna(inplace=True)
+    if df.empty or 'Close' not in df.columns: return pd.DataFrame()
+    if df.index.tz is None: df.index = df.index.tz_localize('UTC')
+    return df.tz_convert('UTC')
+
+def download_bars(symbol, interval, **kw):
+    count_upstream("yfinance")
+    df = yf.download(symbol, interval=interval, progress=False, auto_adjust=True, **kw)
+    if isinstance(df.columns, pd.MultiIndex): df.columns = df.columns.get_level_values(0)
+    return _normalize_bars(df)
+
+def download_bars_batch(symbols, interval, **kw):
+    """同市場的代號合併為一次 yf.download (group_by="ticker")，回傳 {代號: OHLCV (UTC)}；無資料的代號不列入
+    台股與美股交易時區、休市日不同，混在同一請求會對齊到聯集索引並互相補 NaN，故依市場分批"""
+    groups = {}
+    for sym in symbols: groups.setdefault(sym.endswith((".TW", ".TWO")), []).append(sym)
+    out = {}
+    for group in groups.values():
+        count_upstream("yfinance")
+        raw = yf.download(group, interval=interval, progress=False, auto_adjust=True, group_by="ticker", **kw)
+        if not isinstance(raw.columns, pd.MultiIndex): raw = pd.concat({group[0]: raw}, axis=1)
+        for sym in group:
+            if sym not in raw.columns.get_level_values(0): continue
+            df = _normalize_bars(raw[sym].copy())
+            if not df.empty: out[sym] = df
+    return out
+
+def _overlap_anchor(store, symbol, interval):
+    """增量抓取的起點：倒數第二根 (已收盤) K棒，回傳 (ts, close)"""
+    return store.tail_bars(symbol, interval, 2)[-1]
+
+def _history_adjusted(new, anchor):
+    """重疊K棒的調整後收盤價與本地不同 -> 期間內有除權息/分割，本地歷史已過期"""
+    ts, close = anchor
+    ref = new['Close'].get(pd.Timestamp(ts, unit='s', tz='UTC')) if not new.empty else None
+    return ref is not None and not np.isclose(ref, close, rtol=1e-4)
+
+def sync_price_bars(symbol, interval, fetch_period):
+    """只抓取本地最後一根K棒之後的資料並寫回倉儲，回傳涵蓋 fetch_period 的 OHLCV (UTC)
+    auto_adjust 的價格會因除權息回溯改變：增量抓取多帶一根已存K棒比對，不一致時整段重抓"""
+    store = get_market_store()
+    span = PERIOD_DAYS.get(fetch_period, 1)
+    meta = store.bar_meta(symbol, interval)
+    now = time.time()
+    metrics = get_metrics()
+    metrics.count("cache_lookups", "bar_store")
+    try:
+        if meta is None or meta[2] is None or meta[0] < span or now - meta[2] > BAR_START_LIMIT_DAYS.get(interval, 1e9) * 86400:
+            metrics.count("cache_misses", "bar_store")
+            new = download_bars(symbol, interval, period=fetch_period)
+        elif now - meta[1] > BAR_FRESH_SECONDS.get(interval, 600):
+            metrics.count("cache_misses", "bar_store")
+            anchor = _overlap_anchor(store, symbol, interval)
+            new = download_bars(symbol, interval, start=pd.Timestamp(anchor[0], unit='s', tz='UTC').to_pydatetime())
+            if _history_adjusted(new, anchor):
+                new = download_bars(symbol, interval, period=fetch_period)
+                if not new.empty: store.replace_bars(symbol, interval, new, span)
+                new = pd.DataFrame()
+        else:
+            new = pd.DataFrame()
+        if not new.empty: store.append_bars(symbol, interval, new, span)
+    except Exception:
+        pass  # 斷線時退回本地資料
+    meta = store.bar_meta(symbol, interval)
+    if meta is None or meta[2] is None: return pd.DataFrame()
+    # 多抓幾天緩衝，交給呼叫端依交易日裁切
+    return store.load_bars(symbol, interval, since_ts=meta[2] - (span + 7) * 86400)
+
+def sync_price_bars_batch(symbols, interval, fetch_period):
+    """多檔版 sync_price_bars：需要更新的代號合併成一次上游請求，回傳 {代號: OHLCV (UTC)}"""
+    store, metrics = get_market_store(), get_metrics()
+    span = PERIOD_DAYS.get(fetch_period, 1)
+    now = time.time()
+    full, stale = [], []
+    for sym in symbols:
+        meta = store.bar_meta(sym, interval)
+        metrics.count("cache_lookups", "bar_store")
+        if meta is None or meta[2] is None or meta[0] < span or now - meta[2] > BAR_START_LIMIT_DAYS.get(interval, 1e9) * 86400:
+            full.append(sym)
+        elif now - meta[1] > BAR_FRESH_SECONDS.get(interval, 600):
+            stale.append((sym, _overlap_anchor(store, sym, interval)))
+    todo = full + [sym for sym, _ in stale]
+    for _ in todo: metrics.count("cache_misses", "bar_store")
+    try:
+        # 有代號需完整回補時整批抓 fetch_period，否則從最舊的重疊K棒起抓
+        if full: batch = download_bars_batch(todo, interval, period=fetch_period)
+        elif stale: batch = download_bars_batch(todo, interval, start=pd.Timestamp(min(a[0] for _, a in stale), unit='s', tz='UTC').to_pydatetime())
+        else: batch = {}
+        adjusted = [sym for sym, anchor in stale if _history_adjusted(batch.get(sym, pd.DataFrame()), anchor)]
+        for sym, df in batch.items():
+            if sym not in adjusted: store.append_bars(sym, interval, df, span)
+        if adjusted:
+            for sym, df in download_bars_batch(adjusted, interval, period=fetch_period).items(): store.replace_bars(sym, interval, df, span)
+    except Exception:
+        pass  # 斷線時退回本地資料
+    out = {}
+    for sym in symbols:
+        meta = store.bar_meta(sym, interval)
+        if meta is not None and meta[2] is not None:
+            out[sym] = store.load_bars(sym, interval, since_ts=meta[2] - (span + 7) * 86400)
+    return out
+
+# [技術指標引擎] 首次以向量化一次回補整段序列；之後以保存在倉儲中的狀態，每根新K棒 O(1) 推進
+class Indicator:
+    outputs = ()
+
+    def params(self):
+        return f"{type(self).__name__}{vars(self)}"
+
+    def backfill(self, bars):
+        """bars: {'open','high','low','close','volume','ts'} 陣列 -> ({輸出: 陣列}, 最後第二根K棒後的狀態)"""
+        raise NotImplementedError
+
+    def step(self, state, bar):
+        """推進一根K棒 -> ({輸出: 值}, 新狀態)；state 為可 JSON 序列化的 dict，可就地修改"""
+        raise NotImplementedError
+
+def _ewm(x, alpha):
+    return pd.Series(x).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+def _masked(x, first_valid):
+    out = np.array(x, dtype=float)
+    out[:first_valid] = np.nan
+    return out
+
+class SMA(Indicator):
+    def __init__(self, n, name):
+        self.n, self.name = n, name
+        self.outputs = (name,)
+
+    def backfill(self, bars):
+        c, n = bars['close'], self.n
+        cs = np.concatenate([[0.0], np.cumsum(c)])
+        out = np.full(len(c), np.nan)
+        out[n - 1:] = (cs[n:] - cs[:-n]) / n
+        win = c[max(0, len(c) - 1 - n):len(c) - 1].tolist()
+        return {self.name: out}, {"win": win, "sum": sum(win)}
+
+    def step(self, state, bar):
+        state["win"].append(bar['close']); state["sum"] += bar['close']
+        if len(state["win"]) > self.n: state["sum"] -= state["win"].pop(0)
+        return {self.name: state["sum"] / self.n if len(state["win"]) == self.n else np.nan}, state
+
+class EMA(Indicator):
+    def __init__(self, n, name):
+        self.n, self.name = n, name
+        self.outputs = (name,)
+
+    def backfill(self, bars):
+        raw = _ewm(bars['close'], 2 / (self.n + 1))
+        k = len(raw) - 2
+        return {self.name: _masked(raw, self.n - 1)}, {"ema": float(raw[k]) if k >= 0 else None, "count": k + 1}
+
+    def step(self, state, bar):
+        a = 2 / (self.n + 1)
+        state["ema"] = bar['close'] if state["ema"] is None else a * bar['close'] + (1 - a) * state["ema"]
+        state["count"] += 1
+        return {self.name: state["ema"] if state["count"] >= self.n else np.nan}, state
+
+class RSI(Indicator):
+    def __init__(self, n=14):
+        self.n = n
+        self.outputs = ("RSI",)
+
+    @staticmethod
+    def _rsi(gain, loss):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(loss == 0, 100.0, 100 - 100 / (1 + gain / loss))
+
+    def backfill(self, bars):
+        c = bars['close']
+        delta = np.diff(c)
+        ag, al = _ewm(np.clip(delta, 0, None), 1 / self.n), _ewm(np.clip(-delta, 0, None), 1 / self.n)
+        out = np.concatenate([[np.nan], self._rsi(ag, al)]) if len(c) else np.array([])
+        k = len(c) - 2
+        state = {"prev": float(c[k]), "ag": float(ag[k - 1]) if k >= 1 else None, "al": float(al[k - 1]) if k >= 1 else None, "count": max(k, 0)}
+        return {"RSI": _masked(out, self.n)}, state
+
+    def step(self, state, bar):
+        delta = bar['close'] - state["prev"]
+        gain, loss = max(delta, 0.0), max(-delta, 0.0)
+        if state["ag"] is None: state["ag"], state["al"] = gain, loss
+        else:
+            state["ag"] += (gain - state["ag"]) / self.n
+            state["al"] += (loss - state["al"]) / self.n
+        state["prev"], state["count"] = bar['close'], state["count"] + 1
+        return {"RSI": float(self._rsi(state["ag"], state["al"])) if state["count"] >= self.n else np.nan}, state
+
+class MACD(Indicator):
+    def __init__(self, fast=12, slow=26, signal=9):
+        self.fast, self.slow, self.signal = fast, slow, signal
+        self.outputs = ("MACD", "MACD_signal", "MACD_hist")
+
+    def backfill(self, bars):
+        fast, slow = _ewm(bars['close'], 2 / (self.fast + 1)), _ewm(bars['close'], 2 / (self.slow + 1))
+        macd = fast - slow
+        sig = _ewm(macd, 2 / (self.signal + 1))
+        k = len(macd) - 2
+        state = {"fast": float(fast[k]), "slow": float(slow[k]), "sig": float(sig[k]), "count": k + 1} if k >= 0 else {"fast": None, "slow": None, "sig": None, "count": 0}
+        first_sig = self.slow + self.signal - 2
+        return {"MACD": _masked(macd, self.slow - 1), "MACD_signal": _masked(sig, first_sig), "MACD_hist": _masked(macd - sig, first_sig)}, state
+
+    def step(self, state, bar):
+        c = bar['close']
+        if state["fast"] is None: state["fast"] = state["slow"] = c
+        else:
+            state["fast"] += (2 / (self.fast + 1)) * (c - state["fast"])
+            state["slow"] += (2 / (self.slow + 1)) * (c - state["slow"])
+        macd = state["fast"] - state["slow"]
+        state["sig"] = macd if state["sig"] is None else state["sig"] + (2 / (self.signal + 1)) * (macd - state["sig"])
+        state["count"] += 1
+        ok_macd, ok_sig = state["count"] >= self.slow, state["count"] >= self.slow + self.signal - 1
+        return {"MACD": macd if ok_macd else np.nan, "MACD_signal": state["sig"] if ok_sig else np.nan, "MACD_hist": macd - state["sig"] if ok_sig else np.nan}, state
+
+class Bollinger(Indicator):
+    def __init__(self, n=20, k=2):
+        self.n, self.k = n, k
+        self.outputs = ("BB_upper", "BB_mid", "BB_lower")
+
+    def backfill(self, bars):
+        c, n = bars['close'], self.n
+        cs, cs2 = np.concatenate([[0.0], np.cumsum(c)]), np.concatenate([[0.0], np.cumsum(c * c)])
+        mid, std = np.full(len(c), np.nan), np.full(len(c), np.nan)
+        mid[n - 1:] = (cs[n:] - cs[:-n]) / n
+        std[n - 1:] = np.sqrt(np.maximum((cs2[n:] - cs2[:-n]) / n - mid[n - 1:] ** 2, 0))
+        win = c[max(0, len(c) - 1 - n):len(c) - 1].tolist()
+        state = {"win": win, "sum": sum(win), "sum2": sum(x * x for x in win)}
+        return {"BB_upper": mid + self.k * std, "BB_mid": mid, "BB_lower": mid - self.k * std}, state
+
+    def step(self, state, bar):
+        c = bar['close']
+        state["win"].append(c); state["sum"] += c; state["sum2"] += c * c
+        if len(state["win"]) > self.n:
+            old = state["win"].pop(0); state["sum"] -= old; state["sum2"] -= old * old
+        if len(state["win"]) < self.n: return dict.fromkeys(self.outputs, np.nan), state
+        mid = state["sum"] / self.n
+        std = max(state["sum2"] / self.n - mid * mid, 0) ** 0.5
+        return {"BB_upper": mid + self.k * std, "BB_mid": mid, "BB_lower": mid - self.k * std}, state
+
+class ATR(Indicator):
+    def __init__(self, n=14):
+        self.n = n
+        self.outputs = ("ATR",)
+
+    def backfill(self, bars):
+        h, l, c = bars['high'], bars['low'], bars['close']
+        pc = np.concatenate([[np.nan], c[:-1]])
+        tr = np.fmax(h - l, np.fmax(np.abs(h - pc), np.abs(l - pc)))
+        raw = _ewm(tr, 1 / self.n)
+        k = len(c) - 2
+        state = {"prev": float(c[k]), "atr": float(raw[k]), "count": k + 1} if k >= 0 else {"prev": None, "atr": None, "count": 0}
+        return {"ATR": _masked(raw, self.n - 1)}, state
+
+    def step(self, state, bar):
+        h, l = bar['high'], bar['low']
+        tr = h - l if state["prev"] is None else max(h - l, abs(h - state["prev"]), abs(l - state["prev"]))
+        state["atr"] = tr if state["atr"] is None else state["atr"] + (tr - state["atr"]) / self.n
+        state["prev"], state["count"] = bar['close'], state["count"] + 1
+        return {"ATR": state["atr"] if state["count"] >= self.n else np.nan}, state
+
+class VWAP(Indicator):
+    """以 UTC 日期分段 (台/美股單一交易時段皆落在同一 UTC 日內)，每段重新累計"""
+    outputs = ("VWAP",)
+
+    def backfill(self, bars):
+        day = bars['ts'] // 86400
+        tp = (bars['high'] + bars['low'] + bars['close']) / 3
+        cum = pd.DataFrame({"pv": tp * bars['volume'], "v": bars['volume']}).groupby(day).cumsum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = np.where(cum['v'] > 0, cum['pv'] / cum['v'], np.nan)
+        k = len(day) - 2
+        state = {"day": int(day[k]), "pv": float(cum['pv'].iloc[k]), "v": float(cum['v'].iloc[k])} if k >= 0 else {"day": None, "pv": 0.0, "v": 0.0}
+        return {"VWAP": out}, state
+
+    def step(self, state, bar):
+        day = int(bar['ts'] // 86400)
+        if day != state["day"]: state.update(day=day, pv=0.0, v=0.0)
+        state["pv"] += (bar['high'] + bar['low'] + bar['close']) / 3 * bar['volume']
+        state["v"] += bar['volume']
+        return {"VWAP": state["pv"] / state["v"] if state["v"] > 0 else np.nan}, state
+
+INDICATORS = {
+    "MA20": SMA(20, "MA20"), "MA60": SMA(60, "MA60"), "MA250": SMA(250, "MA250"),
+    "EMA12": EMA(12, "EMA12"), "EMA26": EMA(26, "EMA26"),
+    "BOLL": Bollinger(20, 2), "VWAP": VWAP(), "RSI": RSI(14), "MACD": MACD(12, 26, 9), "ATR": ATR(14),
+}
+# 圖表選單 -> 指標；疊加於主圖或另開副圖
+INDICATOR_MENU = {
+    "均線 (MA20/60/250)": ["MA20", "MA60", "MA250"], "EMA (12/26)": ["EMA12", "EMA26"], "布林通道 (20, 2σ)": ["BOLL"],
+    "VWAP": ["VWAP"], "RSI (14)": ["RSI"], "MACD (12/26/9)": ["MACD"], "ATR (14)": ["ATR"],
+}
+OSCILLATOR_MENU = ["RSI (14)", "MACD (12/26/9)", "ATR (14)"]
+
+def compute_indicators(symbol, interval, bars, keys):
+    """回傳與 bars 同索引的指標欄位；已有狀態時只推進最後確認點之後的K棒"""
+    store = get_market_store()
+    ts = bars.index.asi8 // 10**9
+    arrays = {c.lower(): bars[c].to_numpy(dtype=float) for c in ['Open', 'High', 'Low', 'Close', 'Volume']}
+    arrays['ts'] = ts
+    result = pd.DataFrame(index=bars.index)
+    if len(ts) == 0: return result
+    for key in keys:
+        ind = INDICATORS[key]
+        row = store.indicator_state(symbol, interval, key)
+        start = int(np.searchsorted(ts, row[2], side='right')) if row else 0
+        if row is None or row[0] != ind.params() or row[1] > ts[0] or start == 0 or ts[start - 1] != row[2]:
+            values, state = ind.backfill(arrays)
+            store.save_indicator(symbol, interval, key, ind.params(), ts[0], ts[-2] if len(ts) > 1 else None, json.dumps(state), ts, values, reset=True)
+            for out in ind.outputs: result[out] = values[out]
+            continue
+        state, committed = json.loads(row[3]), None
+        new_vals = {out: [] for out in ind.outputs}
+        for i in range(start, len(ts)):
+            vals, state = ind.step(state, {k: arrays[k][i] for k in arrays})
+            for out in ind.outputs: new_vals[out].append(vals[out])
+            if i == len(ts) - 2: committed = json.dumps(state)
+        store.save_indicator(symbol, interval, key, ind.params(), row[1], ts[-2] if committed else None, committed,
+                             ts[start:], {out: np.array(v, dtype=float) for out, v in new_vals.items()})
+        stored = store.load_indicator_values(symbol, interval, ind.outputs, ts[0]).reindex(ts)
+        for out in ind.outputs: result[out] = stored[out].to_numpy() if out in stored.columns else np.nan
+    return result
+
+def indicator_keys(indicators):
+    # 技術指標 (均線固定計算，AI 助手亦使用 MA60)
+    return list(dict.fromkeys(["MA20", "MA60", "MA250"] + [k for label in indicators for k in INDICATOR_MENU.get(label, [])]))
+
+def to_display_frame(df, market, period_label):
+    """UTC K棒 -> 當地時間 'Date' 欄 (無時區)，並裁切至尺度的顯示範圍"""
+    target_tz = 'Asia/Taipei' if market == "台股" else 'America/New_York'
+    df.index = df.index.tz_convert(target_tz)
+
+    df = df.reset_index()
+    df.rename(columns={df.columns[0]: 'Date'}, inplace=True)
+    df['Date'] = df['Date'].dt.tz_localize(None)
+    
+    # 過濾顯示範圍
+    now = datetime.now()
+    if period_label in ["今日", "5日"]:
+        days = df['Date'].dt.normalize()
+        df = df[days.isin(days.drop_duplicates().nlargest(1 if period_label == "今日" else 5))]
+    elif period_label == "1年": df = df[df['Date'] >= (now - timedelta(days=365))]
+    elif period_label == "1月": df = df[df['Date'] >= (now - timedelta(days=30))]
+
+    return df.reset_index(drop=True)
+
+@tracked_cache_frame("price", ttl=600, float32=True)
+def get_price_data(ticker, period_label, market, indicators=()):
     symbol = f"{ticker}.TW" if market == "台股" and ticker.isdigit() else ticker
     p_map = {"今日": "1d", "5日": "5d", "1月": "1mo", "1年": "1y", "5年": "5y"}
     i_map = {"今日": "1m", "5日": "5m", "1月": "60m", "1年": "1d", "5年": "1d"}
@@ -130,61 +862,284 @@ def get_price_data(ticker, period_label, market):
         # [均線補償邏輯] 計算年線(250日)需要更多歷史數據
         fetch_period = "2y" if period_label == "1年" else ("7y" if period_label == "5年" else p_map.get(period_label, "1d"))
         
-        df = yf.download(symbol, period=fetch_period, interval=i_map.get(period_label, "1d"), progress=False, auto_adjust=True)
-        if isinstance(df.columns, pd.MultiIndex): df.columns = df.columns.get_level_values(0)
-        df.columns = [c.capitalize() for c in df.columns] 
-        df.dropna(inplace=True)
-        
+        interval = i_map.get(period_label, "1d")
+        df = sync_price_bars(symbol, interval, fetch_period)
         if df.empty: return pd.DataFrame()
 
-        # 計算均線
-        df['MA20'] = df['Close'].rolling(window=20).mean()
-        df['MA60'] = df['Close'].rolling(window=60).mean()
-        df['MA250'] = df['Close'].rolling(window=250).mean()
+        df = df.join(compute_indicators(symbol, interval, df, indicator_keys(indicators)))
+        return to_display_frame(df, market, period_label)
+    except: return pd.DataFrame()
 
-        if df.index.tz is None: df.index = df.index.tz_localize('UTC')
-        target_tz = 'Asia/Taipei' if market == "台股" else 'America/New_York'
-        df.index = df.index.tz_convert(target_tz)
+# [即時模式] 今日尺度定時只要最後一根K棒之後的資料，併入 session 內的序列
+LIVE_POLL_SECONDS = float(os.environ.get("LIVE_POLL_SECONDS", 10))
+QUOTE_FEED = os.environ.get("QUOTE_FEED")  # 本地行情檔路徑；未設定時輪詢 yfinance
 
-        df = df.reset_index()
-        df.rename(columns={df.columns[0]: 'Date'}, inplace=True)
-        df['Date'] = df['Date'].dt.tz_localize(None)
-        
-        # 過濾顯示範圍
-        now = datetime.now()
-        if period_label == "1年": df = df[df['Date'] >= (now - timedelta(days=365))]
-        elif period_label == "1月": df = df[df['Date'] >= (now - timedelta(days=30))]
+class QuoteFeed:
+    def poll(self, symbol, since):
+        """回傳 since (UTC Timestamp) 之後 (含) 的 1 分K，索引為 UTC"""
+        raise NotImplementedError
 
-        return df
-    except: return pd.DataFrame()
+class YahooQuoteFeed(QuoteFeed):
+    def poll(self, symbol, since):
+        return download_bars(symbol, "1m", start=since.to_pydatetime())
+
+class LocalQuoteFeed(QuoteFeed):
+    """本地行情檔 (CSV: symbol,ts,open,high,low,close,volume；ts 為 UTC epoch 秒)，可由券商 API 或錄製程式持續附加。
+    每次只解析上次讀取位置之後新增的完整行；同一分鐘重複出現時以最後一筆為準。"""
+
+    def __init__(self, path, keep=2000):
+        self.path, self.keep = path, keep
+        self.offset, self.bars = 0, {}
+        self.lock = threading.Lock()
+
+    def _tail(self):
+        try:
+            with open(self.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < self.offset: self.offset, self.bars = 0, {}  # 檔案被截斷或輪替
+                f.seek(self.offset)
+                chunk = f.read()
+        except FileNotFoundError: return
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        self.offset += len(chunk)
+        for line in chunk.decode("utf-8", "ignore").splitlines():
+            parts = line.split(",")
+            if len(parts) != 7: continue
+            try: row = (int(float(parts[1])), *map(float, parts[2:]))
+            except ValueError: continue  # 標頭或格式錯誤的行
+            self.bars.setdefault(parts[0].strip().upper(), deque(maxlen=self.keep)).append(row)
+
+    def poll(self, symbol, since):
+        with self.lock:
+            self._tail()
+            rows = [r for r in self.bars.get(symbol.upper(), ()) if r[0] >= since.timestamp()]
+        if not rows: return pd.DataFrame()
+        df = pd.DataFrame(rows, columns=['ts', 'Open', 'High', 'Low', 'Close', 'Volume']).drop_duplicates('ts', keep='last')
+        df.index = pd.to_datetime(df.pop('ts'), unit='s', utc=True)
+        return df.sort_index()
+
+@st.cache_resource
+def get_quote_feed():
+    return LocalQuoteFeed(QUOTE_FEED) if QUOTE_FEED else YahooQuoteFeed()
+
+def live_price_frame(ticker, market, indicators=()):
+    """即時模式的今日行情：首次由倉儲載入，之後每次只輪詢最後一根K棒起的新資料 (最後一根盤中會變動，一併覆寫)"""
+    symbol = f"{ticker}.TW" if market == "台股" and ticker.isdigit() else ticker
+    live = st.session_state.get("live")
+    if live is None or live[0] != symbol:
+        bars = sync_price_bars(symbol, "1m", "1d")
+    else:
+        bars = live[1]
+        try: new = get_quote_feed().poll(symbol, bars.index[-1]) if not bars.empty else pd.DataFrame()
+        except Exception: new = pd.DataFrame()  # 斷線時沿用上一次的序列
+        if not new.empty:
+            bars = pd.concat([bars[bars.index < new.index[0]], new[['Open', 'High', 'Low', 'Close', 'Volume']]])
+            bars = bars[bars.index >= bars.index[-1] - pd.Timedelta(days=PERIOD_DAYS["1d"] + 7)]
+            get_market_store().append_bars(symbol, "1m", new, PERIOD_DAYS["1d"])
+    st.session_state.live = (symbol, bars)
+    if bars.empty: return pd.DataFrame()
+    # 指標狀態已確認至倒數第二根，每次只推進新增的K棒
+    df = bars.join(compute_indicators(symbol, "1m", bars, indicator_keys(indicators)))
+    return to_display_frame(df, market, "今日")
 
 def add_baseline_line(fig, df, baseline, up_color, down_color, row, col):
-    """基準線多色折線圖邏輯"""
+    """基準線多色折線圖：向量化切段，固定只輸出上/下兩條 trace，各段以 NaN 斷開"""
     if df.empty: return
-    dates, prices = df['Date'].tolist(), df['Close'].tolist()
-    curr_x, curr_y, curr_status = [dates[0]], [prices[0]], prices[0] >= baseline
-    for i in range(1, len(df)):
-        status = prices[i] >= baseline
-        if status == curr_status:
-            curr_x.append(dates[i]); curr_y.append(prices[i])
-        else:
-            color = up_color if curr_status else down_color
-            fig.add_trace(go.Scatter(x=curr_x, y=curr_y, mode='lines', line=dict(color=color, width=2.5), showlegend=False), row=row, col=col)
-            curr_x, curr_y, curr_status = [dates[i-1], dates[i]], [prices[i-1], prices[i]], status
-    fig.add_trace(go.Scatter(x=curr_x, y=curr_y, mode='lines', line=dict(color=(up_color if curr_status else down_color), width=2.5), showlegend=False), row=row, col=col)
-    
-@st.cache_data(ttl=3600)
+    dates, prices = df['Date'].to_numpy(), df['Close'].to_numpy(dtype=float)
+    above = prices >= baseline
+    n = len(prices)
+    flips = np.flatnonzero(above[1:] != above[:-1]) + 1
+    starts, ends = np.r_[0, flips], np.r_[flips, n]
+    seg = np.cumsum(np.isin(np.arange(n), flips))
+    # 每段前置上一段最後一點以保持連續，段尾補一個斷點
+    idx = np.concatenate([np.arange(n), flips - 1, ends - 1])
+    segs = np.concatenate([seg, np.arange(1, len(starts)), np.arange(len(starts))])
+    keys = np.concatenate([np.arange(n), np.full(len(flips), -1), np.full(len(starts), n)])
+    order = np.lexsort((keys, segs))
+    idx, segs, gap = idx[order], segs[order], (keys == n)[order]
+    for state, color in ((True, up_color), (False, down_color)):
+        sel = above[starts][segs] == state
+        if not sel.any(): continue
+        y = np.where(gap[sel], np.nan, prices[idx[sel]])
+        fig.add_trace(go.Scatter(x=dates[idx[sel]], y=y, mode='lines', line=dict(color=color, width=2.5), connectgaps=False, showlegend=False), row=row, col=col)
+
+# [圖表降採樣] 控制送往瀏覽器的點數，不論時間尺度長短
+MAX_CHART_POINTS = 1500
+
+def downsample_ohlc(df, max_points=MAX_CHART_POINTS):
+    """等分桶 OHLC 聚合 (開取首、高取大、低取小、收取末、量加總)，保留 K 線與成交量極值"""
+    if len(df) <= max_points: return df
+    bucket = np.arange(len(df)) * max_points // len(df)
+    agg = {c: 'last' for c in df.columns}
+    agg.update({'Date': 'first', 'Open': 'first', 'High': 'max', 'Low': 'min', 'Volume': 'sum'})
+    return df.groupby(bucket).agg({c: f for c, f in agg.items() if c in df.columns}).reset_index(drop=True)
+
+def lttb_indices(y, n_out=MAX_CHART_POINTS):
+    """Largest-Triangle-Three-Buckets：挑出最能保留折線形狀的 n_out 個點"""
+    n = len(y)
+    if n <= n_out or n_out < 3: return np.arange(n)
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    picked = [0]
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt_lo, nxt_hi = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x, avg_y = x[nxt_lo:nxt_hi].mean(), y[nxt_lo:nxt_hi].mean()
+        a = picked[-1]
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        picked.append(lo + int(area.argmax()))
+    picked.append(n - 1)
+    return np.array(picked)
+
+# [FinMind 擷取] 令牌桶限流 + 退避重試，只補抓本地缺少的季度與交易日，避免一次刷新就用光配額
+FINMIND_TOKEN = os.environ.get("FINMIND_TOKEN", "")
+FINMIND_RATE_PER_HOUR = 600 if FINMIND_TOKEN else 300
+FINMIND_BULK = os.environ.get("FINMIND_BULK", "0") == "1"  # 贊助會員可一次取得單日全市場資料
+FINMIND_RETRIES = 3
+FINMIND_RECHECK = 6 * 3600  # 季報公布期間的重查間隔 (秒)
+FINMIND_START = "2021-01-01"
+FINMIND_COOLDOWN = 300  # 觸及配額上限後暫停請求的秒數
+INST_RECHECK = 900  # 法人資料尚未公布時的重查間隔 (秒)
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.stamp = capacity, time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_s = (1 - self.tokens) / self.rate
+            time.sleep(wait_s)
+
+class FinMindClient:
+    def __init__(self, token, rate_per_hour):
+        from FinMind.data import DataLoader
+        self.api = DataLoader()
+        if token: self.api.login_by_token(api_token=token)
+        self.bucket = TokenBucket(rate_per_hour / 3600, capacity=20)
+        self.cooldown_until = 0.0
+
+    def request(self, method, **kw):
+        for attempt in range(FINMIND_RETRIES):
+            # 配額用盡時不在畫面執行緒上長時間等待：冷卻期間直接失敗，呼叫端退回本地資料
+            if time.monotonic() < self.cooldown_until: raise RuntimeError("FinMind 配額冷卻中")
+            self.bucket.acquire()
+            try:
+                count_upstream("finmind")
+                return getattr(self.api, method)(**kw)
+            except Exception as e:
+                if "limit" in str(e).lower():
+                    self.cooldown_until = time.monotonic() + FINMIND_COOLDOWN
+                    raise
+                if attempt == FINMIND_RETRIES - 1: raise
+                time.sleep(2 ** attempt)
+
+@st.cache_resource
+def get_finmind_client():
+    return FinMindClient(FINMIND_TOKEN, FINMIND_RATE_PER_HOUR)
+
+def latest_tw_trading_day():
+    """已有收盤後資料的最近交易日 (15:00 後才算當日)"""
+    now = pd.Timestamp.now(tz='Asia/Taipei').tz_localize(None)
+    day = now.normalize() - (pd.Timedelta(days=1) if now.hour < 15 else pd.Timedelta(0))
+    while day.weekday() >= 5: day -= pd.Timedelta(days=1)
+    return day.strftime('%Y-%m-%d')
+
+def tw_financials_due(stock_id):
+    """需向 FinMind 補抓財報時回傳起始日，否則 None"""
+    cov = get_market_store().coverage("financial", stock_id)
+    if cov is None: return FINMIND_START
+    # 下一季季末前不可能有新財報；季末後依重查間隔輪詢
+    next_q_end = pd.Timestamp(cov[1]) + pd.offsets.QuarterEnd(1)
+    if pd.Timestamp.now() < next_q_end or time.time() - cov[2] < FINMIND_RECHECK: return None
+    return (pd.Timestamp(cov[1]) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+def sync_tw_financials(stock_id):
+    store, start = get_market_store(), tw_financials_due(stock_id)
+    if start is None: return
+    df = get_finmind_client().request("taiwan_stock_financial_statement", stock_id=stock_id, start_date=start)
+    if df is not None and not df.empty:
+        df = df.dropna(subset=['value'])
+        store.write_rows("fm_financial", list(zip([stock_id] * len(df), df['date'].astype(str), df['type'], df['value'].astype(float))))
+    last = store.query("SELECT MAX(date) AS d FROM fm_financial WHERE stock_id=?", (stock_id,))['d'].iloc[0]
+    if last: store.set_coverage("financial", stock_id, FINMIND_START, last)
+
+def sync_tw_institutional(stock_ids, start_date):
+    """補齊 start_date 至最近交易日之間缺少的法人資料 (只抓前後缺口)；多檔同缺且允許時改以單日全市場批次拉取。
+    涵蓋範圍的結束日只推進到實際取得資料的最後一天：收盤後尚未公布的交易日會在 INST_RECHECK 後重查。
+    每筆回應到達即寫入並更新涵蓋範圍，中途失敗 (如配額冷卻) 時已取得的部分不必重抓"""
+    store, client, end = get_market_store(), get_finmind_client(), latest_tw_trading_day()
+    day = lambda d, n: (pd.Timestamp(d) + pd.Timedelta(days=n)).strftime('%Y-%m-%d')
+    gaps, lead_end = {}, {}  # 代號 -> 待抓區間；代號 -> 前段缺口的結束日 (無前段缺口則不列入)
+    for sid in stock_ids:
+        cov = store.coverage("institutional", sid)
+        if cov is None:
+            gaps[sid], lead_end[sid] = [(start_date, end)], end
+            continue
+        ranges = []
+        if cov[0] > start_date:
+            ranges.append((start_date, day(cov[0], -1)))
+            lead_end[sid] = day(cov[0], -1)
+        if cov[1] < end and time.time() - cov[2] > INST_RECHECK: ranges.append((day(cov[1], 1), end))
+        if ranges: gaps[sid] = ranges
+
+    def write(df):
+        if df is None or df.empty: return
+        store.write_rows("fm_institutional", list(zip(df['stock_id'].astype(str), df['date'].astype(str), df['name'], df['buy'].astype(float), df['sell'].astype(float))))
+
+    def record(sid, done_through):
+        """done_through：該代號已完整抓取到的日期；前段缺口未補齊時起點維持原樣"""
+        cov = store.coverage("institutional", sid)
+        lead_done = sid not in lead_end or lead_end[sid] <= done_through
+        if cov is None and not lead_done: return
+        last = store.query("SELECT MAX(date) AS d FROM fm_institutional WHERE stock_id=?", (sid,))['d'].iloc[0]
+        first = (min(start_date, cov[0]) if cov else start_date) if lead_done else cov[0]
+        # 沒有任何資料時記為起點前一天，之後只重查尾端
+        store.set_coverage("institutional", sid, first, max(filter(None, [last, cov[1] if cov else None, day(first, -1)])))
+
+    if not gaps: return
+    bulk_days = pd.bdate_range(min(r[0] for ranges in gaps.values() for r in ranges), end)
+    if FINMIND_BULK and len(bulk_days) < len(gaps):
+        done_through = None
+        try:
+            for d in bulk_days.strftime('%Y-%m-%d'):
+                df = client.request("taiwan_stock_institutional_investors", stock_id="", start_date=d, end_date=d)
+                if df is not None and not df.empty: write(df[df['stock_id'].isin(list(gaps))])
+                done_through = d
+        finally:
+            if done_through:
+                for sid, ranges in gaps.items():
+                    if ranges[0][0] <= done_through: record(sid, done_through)
+    else:
+        for sid, ranges in gaps.items():
+            done_through = None
+            try:
+                for g_start, g_end in ranges:
+                    df = client.request("taiwan_stock_institutional_investors", stock_id=sid, start_date=g_start, end_date=g_end)
+                    if df is not None and not df.empty: write(df.assign(stock_id=sid))
+                    done_through = g_end
+            finally:
+                if done_through: record(sid, done_through)
+
+@tracked_cache_frame("financial", ttl=3600, categorical=("type",))
 def get_financial_data(ticker, market):
     try:
         if market == "台股":
             clean_id = "".join(filter(str.isdigit, ticker))
-            df = api.taiwan_stock_financial_statement(stock_id=clean_id, start_date='2021-01-01')
-            tw_us_map = {"Revenue": "Total Revenue", "CostOfGoodsSold": "Cost of Revenue", "GrossProfit": "Gross Profit", "OperatingExpenses": "Operating Expense", "OperatingIncome": "Operating Income", "NetIncome": "Net Income", "EPS": "Basic EPS"}
-            df['type'] = df['type'].map(tw_us_map).fillna(df['type'])
-            date_key = 'date' if 'date' in df.columns else df.columns[0]
-            df = df.rename(columns={date_key: 'date'})
+            try: sync_tw_financials(clean_id)
+            except Exception: pass  # 斷線或配額用盡時退回本地資料
+            df = get_market_store().query("SELECT date, type, value FROM fm_financial WHERE stock_id=? ORDER BY date", (clean_id,))
+            df['type'] = df['type'].map(TW_US_ITEMS).fillna(df['type'])
             return df[['date', 'type', 'value']].dropna()
         else:
+            count_upstream("yfinance")
             s = yf.Ticker(ticker)
             f = s.quarterly_financials.T
             df_m = f.reset_index().melt(id_vars='index', var_name='type', value_name='value').rename(columns={'index': 'date'})
@@ -194,316 +1149,1080 @@ def get_financial_data(ticker, market):
             return df_m
     except: return pd.DataFrame()
 
-def calculate_custom_formula(formula_str, pivot_df):
+# [財報寬表] 每檔只 pivot 一次 (日期 × 科目，float64 + categorical 科目名)，各面板直接共用
+@tracked_cache_frame("financial_wide", ttl=3600)
+def get_financial_wide(ticker, market):
+    df = get_financial_data(ticker, market)
+    if df.empty: return pd.DataFrame()
+    with get_metrics().span("pivot"):
+        wide = df.pivot_table(index='date', columns='type', values='value', observed=True).sort_index().astype(float)
+    wide.columns = pd.CategoricalIndex(wide.columns, name='type')
+    return wide
+
+def stack_financial_cube(wides):
+    """{代號: 寬表} 堆疊為 (代號, 日期) × 科目 的資料立方，橫向比較即為切片"""
+    wides = {sid: w for sid, w in wides.items() if not w.empty}
+    if not wides: return pd.DataFrame()
+    cube = pd.concat(wides, names=['代號', 'date'])
+    cube.columns = pd.CategoricalIndex(cube.columns.astype(str), name='type')
+    return cube
+
+def cube_latest(cube):
+    """每檔最新一期財報 (代號 × 科目)"""
+    if cube.empty: return pd.DataFrame()
+    return cube.groupby(level='代號', sort=False).tail(1).droplevel('date')
+
+# [法人彙總] 每日法人淨額依個股預先算好累積淨額、連買賣天數與占成交量比重，存於 inst_agg，面板只讀不算
+INST_GROUPS = {"Foreign_Investor": "foreign_net", "Foreign_Dealer_Self": "foreign_net", "Investment_Trust": "trust_net",
+               "Dealer_self": "dealer_net", "Dealer_Hedging": "dealer_net"}
+INST_WINDOWS = (5, 20, 60)
+INST_AGG_COLUMNS = ["foreign_net", "trust_net", "dealer_net", "total_net"] + [f"cum{n}" for n in INST_WINDOWS] + ["foreign_streak", "foreign_pct"]
+INST_DEFAULT_DAYS = 40  # 面板預設區間，背景預取以同一參數暖快取
+INST_PAD_DAYS = 100  # 區間起點前多補的日曆天數，讓 60 日累積從第一天起即有值
+
+def build_inst_aggregates(raw, volume):
+    """單檔法人日資料 (date, name, buy, sell) + 日成交量 (date -> 股數) -> 以日期為索引的 INST_AGG_COLUMNS"""
+    net = (raw['buy'] - raw['sell']).groupby([raw['date'], raw['name'].map(INST_GROUPS)]).sum().unstack(fill_value=0.0)
+    agg = net.reindex(columns=INST_AGG_COLUMNS[:3], fill_value=0.0).sort_index()
+    agg['total_net'] = agg.sum(axis=1)
+    for n in INST_WINDOWS: agg[f'cum{n}'] = agg['total_net'].rolling(n, min_periods=n).sum()
+    # 連續同向天數：正值為連買、負值為連賣
+    sign = np.sign(agg['foreign_net'])
+    agg['foreign_streak'] = sign * (sign.groupby((sign != sign.shift()).cumsum()).cumcount() + 1)
+    vol = volume.reindex(agg.index)
+    agg['foreign_pct'] = agg['foreign_net'] / vol.where(vol > 0) * 100
+    return agg
+
+def sync_inst_aggregates(stock_ids):
+    """法人資料涵蓋到新交易日、或日K成交量更新過的個股才重算彙總；成交量只讀本地倉儲 (背景預取會保持觀察清單的日K)"""
+    store = get_market_store()
+    for sid in stock_ids:
+        cov, done = store.coverage("institutional", sid), store.coverage("inst_agg", sid)
+        if cov is None: continue
+        bars = store.bar_meta(f"{sid}.TW", "1d")
+        if done is not None and done[0] <= cov[0] and done[1] >= cov[1] and (bars is None or bars[1] <= done[2]): continue
+        raw = store.query("SELECT date, name, buy, sell FROM fm_institutional WHERE stock_id=? ORDER BY date", (sid,))
+        if raw.empty: continue
+        daily = store.load_bars(f"{sid}.TW", "1d", since_ts=pd.Timestamp(raw['date'].iloc[0], tz='Asia/Taipei').timestamp() - 86400)
+        days = daily.index.tz_convert('Asia/Taipei').tz_localize(None).round("D").strftime('%Y-%m-%d')
+        volume = pd.Series(daily['Volume'].to_numpy(dtype=float), index=days)
+        agg = build_inst_aggregates(raw, volume[~volume.index.duplicated(keep='last')])
+        store.write_rows("inst_agg", [(sid, d, *(None if pd.isna(v) else float(v) for v in row))
+                                      for d, row in zip(agg.index, agg[INST_AGG_COLUMNS].itertuples(index=False))])
+        store.set_coverage("inst_agg", sid, cov[0], cov[1])
+
+def sync_institutional(stock_ids, days):
+    start = (datetime.now() - timedelta(days=days + INST_PAD_DAYS)).strftime('%Y-%m-%d')
+    try: sync_tw_institutional(stock_ids, start)
+    except Exception: pass  # 斷線或配額用盡時退回本地資料
+    sync_inst_aggregates(stock_ids)
+
+@tracked_cache_frame("institutional", ttl=1800, categorical=("name",))
+def get_institutional_data(ticker, days=INST_DEFAULT_DAYS):
+    clean_id = "".join(filter(str.isdigit, ticker))
+    start = (datetime.now()-timedelta(days=days)).strftime('%Y-%m-%d')
+    sync_institutional([clean_id], days)
+    return get_market_store().query("SELECT date, stock_id, name, buy, sell FROM fm_institutional WHERE stock_id=? AND date>=? ORDER BY date", (clean_id, start))
+
+@tracked_cache_frame("institutional_flow", ttl=1800)
+def get_institutional_flow(ticker, days=INST_DEFAULT_DAYS):
+    """單檔逐日法人彙總 (由遠到近)，區間任意"""
+    clean_id = "".join(filter(str.isdigit, ticker))
+    start = (datetime.now()-timedelta(days=days)).strftime('%Y-%m-%d')
+    sync_institutional([clean_id], days)
+    return get_market_store().query("SELECT * FROM inst_agg WHERE stock_id=? AND date>=? ORDER BY date", (clean_id, start))
+
+@tracked_cache_frame("institutional_summary", ttl=1800)
+def get_institutional_summary(stock_ids):
+    """觀察清單各檔最新一日的法人彙總 (代號為索引)；非台股代號略過"""
+    ids = [sid for sid in stock_ids if sid.isdigit()]
+    if not ids: return pd.DataFrame()
+    sync_institutional(ids, max(INST_WINDOWS))
+    marks = ",".join("?" * len(ids))
+    return get_market_store().query(f"""SELECT a.* FROM inst_agg a JOIN (SELECT stock_id, MAX(date) AS date FROM inst_agg
+                                        WHERE stock_id IN ({marks}) GROUP BY stock_id) m USING (stock_id, date)""", ids).set_index('stock_id')
+
+# [info 快照快取] 全程序共用：TTL 內直接回傳；過期先回舊值並於背景刷新；同代號同時請求只打一次上游
+INFO_TTL = int(os.environ.get("INFO_TTL", 900))  # 秒
+INFO_MAX_ENTRIES = int(os.environ.get("INFO_MAX_ENTRIES", 2000))  # 超過時淘汰最久未使用的代號
+INFO_RETRY_SECONDS = 60  # 抓取失敗後的重試間隔，期間內直接回舊值或失敗
+
+class InfoCache:
+    def __init__(self, ttl, max_entries, retry_after, max_workers=4):
+        self.ttl, self.max_entries, self.retry_after = ttl, max_entries, retry_after
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # symbol -> (info, 抓取時間) (LRU)
+        self.failed = OrderedDict()   # symbol -> 上次失敗時間
+        self.inflight = {}  # symbol -> Future
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="info")
+
+    def _refresh(self, symbol):
+        try:
+            count_upstream("yfinance")
+            info = yf.Ticker(symbol).info or {}
+            with self.lock:
+                self.entries[symbol] = (info, time.time())
+                self.entries.move_to_end(symbol)
+                self.failed.pop(symbol, None)
+                while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+            return info
+        except Exception:
+            with self.lock:
+                self.failed[symbol] = time.time()
+                self.failed.move_to_end(symbol)
+                while len(self.failed) > self.max_entries: self.failed.popitem(last=False)
+            raise
+        finally:
+            with self.lock: self.inflight.pop(symbol, None)
+
+    def get(self, symbol, timeout=None):
+        metrics = get_metrics()
+        metrics.count("cache_lookups", "info")
+        with self.lock:
+            entry = self.entries.get(symbol)
+            if entry: self.entries.move_to_end(symbol)
+            if entry and time.time() - entry[1] < self.ttl: return entry[0]
+            fut = self.inflight.get(symbol)
+            if fut is None:
+                # 剛失敗過的代號在退避期間不重送上游
+                if time.time() - self.failed.get(symbol, 0) < self.retry_after:
+                    if entry: return entry[0]
+                    metrics.count("cache_misses", "info")
+                    raise RuntimeError(f"{symbol} info 抓取失敗，稍後重試")
+                fut = self.inflight[symbol] = self.pool.submit(self._refresh, symbol)
+        if entry: return entry[0]  # 過期仍算命中 (回舊值)
+        metrics.count("cache_misses", "info")
+        return fut.result(timeout=timeout)
+
+@st.cache_resource
+def get_info_cache():
+    return InfoCache(INFO_TTL, INFO_MAX_ENTRIES, INFO_RETRY_SECONDS)
+
+def get_ticker_info(symbol):
+    return get_info_cache().get(symbol)
+
+# [同業並行抓取] 有界執行緒池 + 單檔逾時，避免單一慢速代號拖住整個對比
+PEER_MAX_WORKERS = 8
+PEER_TIMEOUT = 20  # 單檔逾時 (秒)
+
+def fetch_peer_snapshot(sid, started):
+    started[sid] = time.time()
+    m_t = "台股" if sid.isdigit() else "美股"
+    wide = get_financial_wide(sid, m_t)
+    s_info = get_ticker_info(f"{sid}.TW" if m_t=="台股" else sid)
+    return wide, s_info
+
+def stream_peer_snapshots(peers):
+    """依完成順序逐筆產出 (代號, 財報, info)；逾時或失敗者產出 (代號, None, None)。
+    每次對比使用自己的執行緒池：已在執行的上游呼叫無法取消，卡住的執行緒只會留在這次的池中，不佔用之後的對比"""
+    pool = ThreadPoolExecutor(max_workers=PEER_MAX_WORKERS, thread_name_prefix="peer")
+    started = {}
+    futures = {pool.submit(fetch_peer_snapshot, sid, started): sid for sid in peers}
+    pending = set(futures)
+    # 排隊中的任務尚未計時，另設整體期限防止池被卡死時無限等待
+    deadline = time.time() + PEER_TIMEOUT * (len(futures) // PEER_MAX_WORKERS + 2)
     try:
-        if pivot_df.empty: return pd.Series(dtype=float)
-        eval_str = formula_str.strip()
-        available_cols = sorted(pivot_df.columns, key=len, reverse=True)
-        for col in available_cols:
-            if col in eval_str:
-                eval_str = eval_str.replace(col, f"pivot_df['{col}']")
-        return eval(eval_str, {"__builtins__": None}, {"pivot_df": pivot_df})
-    except:
-        return pd.Series(0, index=pivot_df.index)
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    wide, s_info = fut.result()
+                    yield futures[fut], wide, s_info
+                except Exception:
+                    yield futures[fut], None, None
+            now = time.time()
+            expired = [f for f in pending if now > deadline or (futures[f] in started and now - started[futures[f]] > PEER_TIMEOUT)]
+            for fut in expired:
+                pending.discard(fut)
+                fut.cancel()
+                yield futures[fut], None, None
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def build_peer_table(latest, infos, sel_c, custom_ratios):
+    """latest: 代號 × 科目 最新一期財報；自定義公式對整個同業面板一次向量化運算"""
+    tickers = list(infos)
+    panel = latest.reindex(pd.Index(tickers, name="代號"))
+    table, errors = pd.DataFrame(index=panel.index), []
+    for m in sel_c:
+        if m in YF_RATIOS:
+            raw = pd.to_numeric(pd.Series([infos[t].get(YF_RATIOS[m]) for t in tickers], index=panel.index), errors='coerce')
+            table[m] = raw * 100 if YF_RATIOS[m] in PERCENTAGE_FIELDS else raw
+        elif m in custom_ratios:
+            try: table[m] = calculate_custom_formula(custom_ratios[m], panel)
+            except FormulaError as e:
+                table[m] = np.nan; errors.append(f"{m}: {e}")
+        else:
+            table[m] = panel[m] if m in panel.columns else np.nan
+    return table.reset_index(), errors
+
+# [同業股價疊圖] 整個資料夾一次下載日K，對齊到共同日曆後重設基期
+PEER_PRICE_SCALES = {"1月": ("1mo", 30), "1年": ("2y", 365), "5年": ("7y", 365 * 5)}
+
+def align_closes(bars):
+    """{代號: 日K (UTC)} -> 以各交易所當地日期為索引的收盤價表。
+    同一日期台股收盤 (UTC 05:30) 早於美股 (UTC 21:00)，依日期排序即為時間先後；
+    一方休市的日子沿用前一收盤。日K 的時間戳可能是當地午夜或 UTC 午夜，轉成當地時間後取最近的整日即可兩者皆正確。"""
+    closes = {}
+    for sid, df in bars.items():
+        tz = 'Asia/Taipei' if sid.isdigit() else 'America/New_York'
+        days = df.index.tz_convert(tz).tz_localize(None).round("D")
+        s = pd.Series(df['Close'].to_numpy(dtype=float), index=days)
+        closes[sid] = s[~s.index.duplicated(keep='last')]
+    return pd.DataFrame(closes).sort_index().ffill()
+
+@tracked_cache_frame("peer_prices", ttl=600, float32=True)
+def get_peer_returns(peers, scale):
+    """資料夾內各檔自期間起點的累積報酬 (%)，index 為日期、欄位為代號"""
+    fetch_period, days = PEER_PRICE_SCALES[scale]
+    symbols = {sid: f"{sid}.TW" if sid.isdigit() else sid for sid in peers}
+    bars = sync_price_bars_batch(list(dict.fromkeys(symbols.values())), "1d", fetch_period)
+    panel = align_closes({sid: bars[sym] for sid, sym in symbols.items() if sym in bars and not bars[sym].empty})
+    if panel.empty: return panel
+    panel = panel[panel.index >= pd.Timestamp.now().normalize() - pd.Timedelta(days=days)]
+    # 各檔以區間內第一個有效收盤為基期
+    return (panel / panel.bfill().iloc[0] - 1) * 100
+
+# [自定義公式引擎] 公式只解析一次成運算樹並依字串快取，之後對整個面板一次 NumPy 向量化運算
+class FormulaError(ValueError):
+    pass
+
+FORMULA_TOKEN = re.compile(r"\s*([+\-*/()])\s*")
+
+@functools.lru_cache(maxsize=256)
+def compile_formula(formula_str):
+    """運算樹節點: ('num', 值) / ('col', 科目) / ('neg', 子樹) / (運算子, 左, 右)"""
+    tokens = [t.strip() for t in FORMULA_TOKEN.split(formula_str) if t.strip()]
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def expr():
+        node = term()
+        while peek() in ("+", "-"):
+            op = take(); node = (op, node, term())
+        return node
+
+    def term():
+        node = factor()
+        while peek() in ("*", "/"):
+            op = take(); node = (op, node, factor())
+        return node
+
+    def factor():
+        if peek() is None: raise FormulaError("公式不完整")
+        tok = take()
+        if tok == "-": return ("neg", factor())
+        if tok == "+": return factor()
+        if tok == "(":
+            node = expr()
+            if peek() != ")": raise FormulaError("括號未閉合")
+            take()
+            return node
+        if tok in ("*", "/", ")"): raise FormulaError(f"第 {pos} 個符號「{tok}」位置錯誤")
+        try: return ("num", float(tok))
+        except ValueError: pass
+        # 只接受已知科目 (台股科目名換成標準名)；連續兩個科目或拼錯都在此擋下
+        item = TW_US_ITEMS.get(tok, tok)
+        if item not in US_STD_ORDER: raise FormulaError(f"無法識別的科目「{tok}」")
+        return ("col", item)
+
+    if not tokens: raise FormulaError("公式為空")
+    tree = expr()
+    if pos < len(tokens): raise FormulaError(f"無法解析「{' '.join(tokens[pos:])}」")
+    return tree
+
+def evaluate_formula(node, panel):
+    kind = node[0]
+    if kind == "num": return node[1]
+    if kind == "col":
+        if node[1] not in panel.columns: raise FormulaError(f"財報缺少科目「{node[1]}」")
+        return panel[node[1]].to_numpy(dtype=float)
+    if kind == "neg": return -evaluate_formula(node[1], panel)
+    left, right = evaluate_formula(node[1], panel), evaluate_formula(node[2], panel)
+    if kind == "+": return left + right
+    if kind == "-": return left - right
+    if kind == "*": return left * right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(right == 0, np.nan, np.divide(left, right))
+
+def calculate_custom_formula(formula_str, pivot_df):
+    """pivot_df 可為單檔 (日期 × 科目) 或多檔堆疊面板；除以零得 NaN，語法錯誤或缺少科目拋出 FormulaError"""
+    if pivot_df.empty: return pd.Series(dtype=float)
+    res = evaluate_formula(compile_formula(formula_str.strip()), pivot_df)
+    if np.ndim(res) == 0: res = np.full(len(pivot_df), res, dtype=float)
+    return pd.Series(res, index=pivot_df.index)
+
+# [篩選器] 全市場基本面表於背景離線更新並存入倉儲；篩選時對所有代號逐欄一次運算
+FUNDAMENTALS_MAX_AGE = 24 * 3600  # 秒，較新的代號更新時略過，可中斷後續跑
+SCREENER_WORKERS = 4
+SCREENER_POLL_SECONDS = 1.0  # 背景更新進度條的刷新間隔
+SCREENER_FINMIND_BUDGET = FINMIND_RATE_PER_HOUR // 4  # 每輪最多補抓的台股財報檔數，保留其餘配額給畫面
+
+@st.cache_data(ttl=86400)
+def get_tw_universe():
+    """台股上市普通股 (代號 -> 名稱)"""
+    df = get_finmind_client().request("taiwan_stock_info")
+    df = df[(df['type'] == 'twse') & df['stock_id'].str.fullmatch(r"\d{4}")].drop_duplicates('stock_id')
+    return dict(zip(df['stock_id'], df['stock_name']))
+
+@tracked_cache_frame("fundamentals", ttl=300, categorical=("market",))
+def get_fundamentals_table(version):
+    """代號 × 欄位 寬表 (version 為最後更新時間，資料更新後自動失效)"""
+    store = get_market_store()
+    long = store.query("SELECT symbol, field, value FROM fundamentals")
+    meta = store.query("SELECT symbol, market, name, updated_at FROM fundamental_meta").set_index('symbol')
+    if long.empty: return pd.DataFrame()
+    return meta.join(long.pivot(index='symbol', columns='field', values='value'), how='inner')
+
+def fundamentals_version():
+    return get_market_store().query("SELECT MAX(updated_at) AS v FROM fundamental_meta")['v'].iloc[0]
+
+class FundamentalsRefresher:
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.running, self.total, self.done, self.failed, self.deferred = False, 0, 0, 0, 0
+
+    def start(self, symbols):
+        """symbols: {代號: (市場, 名稱)}；已有工作在跑時忽略"""
+        with self.lock:
+            if self.running: return False
+            self.running, self.total, self.done, self.failed, self.deferred = True, 0, 0, 0, 0
+        threading.Thread(target=self._run, args=(symbols,), name="fundamentals-refresh", daemon=True).start()
+        return True
+
+    def _run(self, symbols):
+        try:
+            updated = get_market_store().query("SELECT symbol, updated_at FROM fundamental_meta").set_index('symbol')['updated_at'].to_dict()
+            # 最久未更新的優先；需打 FinMind 的台股超過本輪額度時順延到下一輪 (不標記為已更新)
+            todo = sorted((sid for sid in symbols if time.time() - updated.get(sid, 0) > FUNDAMENTALS_MAX_AGE), key=lambda sid: updated.get(sid, 0))
+            due = [sid for sid in todo if symbols[sid][0] == "台股" and tw_financials_due(sid) is not None]
+            deferred = set(due[SCREENER_FINMIND_BUDGET:])
+            todo = [sid for sid in todo if sid not in deferred]
+            with self.lock: self.total, self.deferred = len(todo), len(deferred)
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fundamentals") as pool:
+                for fut in [pool.submit(self._refresh_one, sid, *symbols[sid]) for sid in todo]:
+                    ok = fut.exception() is None
+                    with self.lock:
+                        self.done += 1
+                        self.failed += not ok
+        finally:
+            with self.lock: self.running = False
+
+    @staticmethod
+    def _refresh_one(sid, market, name):
+        info = get_info_cache().get(f"{sid}.TW" if market == "台股" else sid)
+        # 財報同步失敗 (含配額冷卻) 直接拋出：計入失敗且不寫入 updated_at，下一輪重試
+        if market == "台股": sync_tw_financials(sid)
+        wide = get_financial_wide(sid, market)
+        if wide.empty and market == "台股" and get_market_store().coverage("financial", sid):
+            raise RuntimeError(f"{sid} 財報快取尚未更新")
+        fields = {f: info.get(f) for f in YF_RATIOS.values()}
+        if not wide.empty: fields.update({str(k): v for k, v in wide.iloc[-1].items()})
+        fields = {k: float(v) for k, v in fields.items() if isinstance(v, (int, float)) and not pd.isna(v)}
+        get_market_store().save_fundamentals(sid, market, name or info.get('shortName', sid), fields)
+
+@st.cache_resource
+def get_fundamentals_refresher():
+    return FundamentalsRefresher(SCREENER_WORKERS)
+
+def screen_universe(table, conditions, custom_ratios, rank_by, ascending):
+    """conditions: [(指標, 運算子, 門檻)]；各指標整欄一次計算後以布林遮罩篩選並排序"""
+    metrics = {}
+    for m in {c[0] for c in conditions} | {rank_by}:
+        if m in YF_RATIOS:
+            col = table[YF_RATIOS[m]] if YF_RATIOS[m] in table.columns else pd.Series(np.nan, index=table.index)
+            metrics[m] = col * 100 if YF_RATIOS[m] in PERCENTAGE_FIELDS else col
+        elif m in custom_ratios:
+            metrics[m] = calculate_custom_formula(custom_ratios[m], table)
+    result = pd.concat([table[['name', 'market']], pd.DataFrame(metrics, index=table.index)], axis=1)
+    mask = pd.Series(True, index=table.index)
+    for m, op, threshold in conditions:
+        mask &= (result[m] >= threshold) if op == "≥" else (result[m] <= threshold)
+    return result[mask].sort_values(rank_by, ascending=ascending, na_position='last')
+
+# [背景預取] 依台/美股交易時段各自的節奏，讓觀察清單內的行情、財報、info 與法人資料常駐快取
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_WORKERS = 4
+PREFETCH_INTERVALS = {"open": 300, "closed": 3600}  # 盤中 / 盤後刷新間隔 (秒)，盤中須短於行情快取 TTL
+PREFETCH_SCALES = ["今日", "1年"]
+MARKET_SESSIONS = {"台股": ("Asia/Taipei", "09:00", "13:30"), "美股": ("America/New_York", "09:30", "16:00")}
+
+def market_is_open(market):
+    tz, open_t, close_t = MARKET_SESSIONS[market]
+    now = pd.Timestamp.now(tz=tz)
+    return now.weekday() < 5 and open_t <= now.strftime("%H:%M") <= close_t
+
+class PrefetchScheduler:
+    def __init__(self, workers):
+        self.lock = threading.Lock()
+        self.symbols = {}      # 代號 -> 市場
+        self.running = set()   # 上一輪尚未完成的代號不重複排入
+        self.next_run = {m: 0.0 for m in MARKET_SESSIONS}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        threading.Thread(target=self._loop, name="prefetch-scheduler", daemon=True).start()
+
+    def register(self, watchlists):
+        symbols = {sid: "台股" if sid.isdigit() else "美股" for tickers in watchlists.values() for sid in tickers}
+        with self.lock:
+            new = [sid for sid in symbols if sid not in self.symbols]
+            self.symbols = symbols
+        for sid in new: self._submit(sid)  # 新加入的代號立即預熱
+
+    def _submit(self, sid):
+        with self.lock:
+            market = self.symbols.get(sid)
+            if market is None or sid in self.running: return
+            self.running.add(sid)
+        self.pool.submit(self._warm, sid, market)
+
+    def _loop(self):
+        while True:
+            now = time.time()
+            for market in MARKET_SESSIONS:
+                if now < self.next_run[market]: continue
+                self.next_run[market] = now + PREFETCH_INTERVALS["open" if market_is_open(market) else "closed"]
+                with self.lock: batch = [sid for sid, m in self.symbols.items() if m == market]
+                for sid in batch: self._submit(sid)
+            time.sleep(min(max(min(self.next_run.values()) - time.time(), 1), 60))
+
+    def _warm(self, sid, market):
+        try:
+            for scale in PREFETCH_SCALES: get_price_data(sid, scale, market)
+            get_financial_wide(sid, market)
+            get_info_cache().get(f"{sid}.TW" if market == "台股" else sid)
+            if market == "台股":
+                get_institutional_data(sid, INST_DEFAULT_DAYS)
+                get_institutional_flow(sid, INST_DEFAULT_DAYS)
+        except Exception:
+            pass
+        finally:
+            with self.lock: self.running.discard(sid)
+
+@st.cache_resource
+def get_prefetch_scheduler():
+    scheduler, store = PrefetchScheduler(PREFETCH_WORKERS), get_portfolio_store()
+    # 觀察清單異動時立即更新預取名單
+    store.subscribe(lambda: scheduler.register(store.snapshot()[1]["watchlists"]))
+    scheduler.register(store.snapshot()[1]["watchlists"])
+    return scheduler
+
+if PREFETCH_ENABLED: get_prefetch_scheduler()
+
+# [AI 助手] 每檔預先整理精簡摘要 (趨勢、關鍵比率、最新財報) 供多次提問共用；回覆依 (模型, 摘要, 問題) 雜湊快取
+AI_MODEL = os.environ.get("AI_MODEL", "gpt-3.5-turbo")
+AI_BACKEND = os.environ.get("AI_BACKEND", "")  # "local" 時一律使用本地替身模型 (測試用)
+AI_DIGEST_TTL = int(os.environ.get("AI_DIGEST_TTL", 600))  # 秒
+AI_CACHE_SIZE = 512
+AI_SYSTEM_PROMPT = "你是一位專業的證券分析師。請根據提供的數據, 問題給出具體的投資分析與風險提示。\n"
+DIGEST_RATIOS = ["本益比 (PE, Trailing)", "股價淨值比 (PB)", "淨利率 (Net Margin)", "ROE", "負債權益比", "殖利率 (Yield)"]
+DIGEST_ITEMS = ["Total Revenue", "Gross Profit", "Operating Income", "Net Income", "Basic EPS"]
+
+class ChatModel:
+    name = ""
+
+    def complete(self, digest, question):
+        """依摘要回答問題，逐段產出文字"""
+        raise NotImplementedError
+
+@st.cache_resource
+def get_openai_client(api_key):
+    """同一把金鑰全程序共用一個連線池"""
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+class OpenAIChatModel(ChatModel):
+    def __init__(self, client, model):
+        self.client, self.name = client, model
+
+    def complete(self, digest, question):
+        count_upstream("openai")
+        response = self.client.chat.completions.create(
+            model=self.name,
+            messages=[{"role": "system", "content": AI_SYSTEM_PROMPT + digest["text"]}, {"role": "user", "content": question}],
+            stream=True
+        )
+        for chunk in response:
+            if chunk.choices[0].delta.content: yield chunk.choices[0].delta.content
+
+class LocalChatModel(ChatModel):
+    """不連網的替身模型：只依摘要套用固定句型，供未設定 API Key 或測試時使用"""
+    name = "local"
+
+    def complete(self, digest, question):
+        price = digest["price"]
+        for part in (f"根據檢索，{digest['ticker']} 目前{digest['trend']}。",
+                     f"技術面上，短線支撐約在 {round(price * 0.95, 2)} 附近，壓力約在 {round(price * 1.05, 2)}。",
+                     "考量到當前市場波動，建議分批佈局。"):
+            yield part
+
+def _fmt_amount(item, v):
+    return f"{v:.2f}" if item == "Basic EPS" else f"{v / 1e8:,.1f} 億"
+
+def build_digest(ticker, market):
+    """單檔精簡摘要：日線收盤與季線、近一年漲跌、關鍵比率、最新一期財報；無行情時回傳 None"""
+    hist = get_price_data(ticker, "1年", market)
+    if hist.empty: return None
+    price, ma60 = float(hist['Close'].iloc[-1]), float(hist['MA60'].iloc[-1])
+    trend = "站在季線上方 (多頭趨勢)" if price > ma60 else "位居季線下方 (空頭趨勢)"
+    lines = [f"{ticker} ({market}) 收盤 {price:.2f}，季線(MA60) {ma60:.2f}，{trend}，近一年漲跌 {(price / float(hist['Close'].iloc[0]) - 1) * 100:+.1f}%。"]
+    info = get_ticker_info(f"{ticker}.TW" if market == "台股" else ticker)
+    ratios = []
+    for label in DIGEST_RATIOS:
+        v = info.get(YF_RATIOS[label])
+        if isinstance(v, (int, float)):
+            ratios.append(f"{label} {v * 100:.1f}%" if YF_RATIOS[label] in PERCENTAGE_FIELDS else f"{label} {v:.2f}")
+    if ratios: lines.append("關鍵比率：" + "、".join(ratios))
+    wide = get_financial_wide(ticker, market)
+    if not wide.empty:
+        latest = wide.iloc[-1]
+        items = [f"{m} {_fmt_amount(m, latest[m])}" for m in DIGEST_ITEMS if m in latest.index and pd.notna(latest[m])]
+        if items: lines.append(f"最新財報 ({wide.index[-1]})：" + "、".join(items))
+    return {"ticker": ticker, "market": market, "price": round(price, 2), "trend": trend, "text": "\n".join(lines)}
+
+class AIAssistant:
+    def __init__(self, digest_ttl, max_responses, max_workers=4):
+        self.digest_ttl, self.max_responses = digest_ttl, max_responses
+        self.lock = threading.Lock()
+        self.digests = {}            # (代號, 市場) -> (摘要, 建立時間)
+        self.responses = OrderedDict()  # 雜湊 -> 回覆全文 (LRU)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="digest")
+
+    def digest(self, ticker, market):
+        metrics = get_metrics()
+        metrics.count("cache_lookups", "ai_digest")
+        with self.lock: entry = self.digests.get((ticker, market))
+        if entry and time.time() - entry[1] < self.digest_ttl: return entry[0]
+        metrics.count("cache_misses", "ai_digest")
+        d = build_digest(ticker, market)
+        with self.lock: self.digests[(ticker, market)] = (d, time.time())
+        return d
+
+    def batch_digests(self, tickers):
+        """整個觀察清單並行建立摘要 -> {代號: 摘要或 None}"""
+        markets = {sid: "台股" if sid.isdigit() else "美股" for sid in tickers}
+        futures = {sid: self.pool.submit(self.digest, sid, m) for sid, m in markets.items()}
+        out = {}
+        for sid, fut in futures.items():
+            try: out[sid] = fut.result(timeout=PEER_TIMEOUT)
+            except Exception: out[sid] = None
+        return out
+
+    def ask(self, model, digest, question):
+        """逐段產出回覆；同一模型、摘要與問題已回答過時直接回傳快取全文"""
+        key = hashlib.sha256(f"{model.name}\n{digest['text']}\n{question.strip()}".encode("utf-8")).hexdigest()
+        metrics = get_metrics()
+        metrics.count("cache_lookups", "ai_response")
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None: self.responses.move_to_end(key)
+        if cached is not None:
+            yield cached
+            return
+        metrics.count("cache_misses", "ai_response")
+        full = ""
+        for part in model.complete(digest, question):
+            full += part
+            yield part
+        with self.lock:
+            self.responses[key] = full
+            while len(self.responses) > self.max_responses: self.responses.popitem(last=False)
+
+@st.cache_resource
+def get_ai_assistant():
+    return AIAssistant(AI_DIGEST_TTL, AI_CACHE_SIZE)
 
 # --- 3. 介面佈局 ---
+# 側邊欄與各面板皆為 st.fragment：元件互動只重跑所在片段，
+# 只有影響其他面板的變動 (資料夾內容、已存公式) 才觸發整頁重跑。
+MA_LABEL = "均線 (MA20/60/250)"
+MARKET_COLORS = {"台股": ("#FF3333", "#00AA00", "NT$"), "美股": ("#00AA00", "#FF3333", "US$")}
+
+FOLDER_VIEWS = {"同業對比", "三大法人/機構持有"}  # 分析面板中會讀取目前資料夾的檢視
+
+def rerun_for_folder():
+    """資料夾變動只影響讀取目前資料夾的分析檢視；未顯示時僅重跑所在片段。"""
+    sync_portfolio()
+    if st.session_state.get("view_option") in FOLDER_VIEWS: st.rerun()
+    else: st.rerun(scope="fragment")
+
+@st.fragment
+def folder_editor(main_id):
+    for fn in list(st.session_state.db["watchlists"].keys()):
+        icon = "📂" if st.session_state.active_folder == fn else "📁"
+        if st.button(f"{icon} {fn}", key=f"f_{fn}"):
+            st.session_state.active_folder = fn; rerun_for_folder()
+        if st.session_state.active_folder == fn:
+            for s in st.session_state.db["watchlists"][fn]: st.write(f"&nbsp;&nbsp;&nbsp;&nbsp;📄 `{s}`")
+    
+    st.divider()
+    st.write("**股票管理**")
+    if st.button(f"加入 {main_id}", use_container_width=True):
+        if st.session_state.active_folder:
+            if main_id not in st.session_state.db["watchlists"][st.session_state.active_folder]:
+                portfolio.add_ticker(st.session_state.active_folder, main_id); rerun_for_folder()
+        else: st.warning("請先選擇一個資料夾")
+
+    if st.button(f"移除 {main_id}", use_container_width=True):
+        if st.session_state.active_folder:
+            if main_id in st.session_state.db["watchlists"][st.session_state.active_folder]:
+                portfolio.remove_ticker(st.session_state.active_folder, main_id); rerun_for_folder()
+        else: st.warning("請先選擇一個資料夾")
+        
+    st.divider()
+    st.write("**資料夾管理**")
+    new_folder_name = st.text_input("新資料夾名稱", placeholder="輸入名稱...", label_visibility="collapsed")
+    if st.button("✨ 建立新資料夾", use_container_width=True):
+        if new_folder_name and new_folder_name not in st.session_state.db["watchlists"]:
+            # 新資料夾為空，不影響其他面板
+            portfolio.add_folder(new_folder_name); sync_portfolio(); st.rerun(scope="fragment")
+    
+    if st.button("🗑️ 刪除選中資料夾", use_container_width=True):
+        if st.session_state.active_folder:
+            portfolio.delete_folder(st.session_state.active_folder)
+            st.session_state.active_folder = None
+            rerun_for_folder()
+
+def _formula_push(token):
+    st.session_state.formula_buffer += f"{token} "
+
+def _formula_back():
+    buf = st.session_state.formula_buffer.strip()
+    st.session_state.formula_buffer = buf.rsplit(' ', 1)[0] + ' ' if ' ' in buf else ""
+
+def _formula_clear():
+    st.session_state.formula_buffer = ""
+
+@st.fragment
+def formula_builder():
+    # 按鍵以 on_click 更新緩衝區，只重跑本片段
+    st.write("目前公式:")
+    st.info(st.session_state.formula_buffer if st.session_state.formula_buffer else "(空)")
+    st.selectbox("選擇財報科目", list(US_STD_ORDER.keys()), key="formula_item", label_visibility="collapsed")
+    st.button("加入科目", use_container_width=True, on_click=lambda: _formula_push(st.session_state.formula_item))
+        
+    c1, c2, c3, c4 = st.columns(4)
+    c1.button("＋", key="btn_add", on_click=_formula_push, args=("+",))
+    c2.button("−", key="btn_sub", on_click=_formula_push, args=("-",))
+    c3.button("×", key="btn_mul", on_click=_formula_push, args=("*",))
+    c4.button("÷", key="btn_div", on_click=_formula_push, args=("/",))
+    
+    c5, c6, c7, c8 = st.columns(4)
+    c5.button("(", key="btn_p1", on_click=_formula_push, args=("(",))
+    c6.button(")", key="btn_p2", on_click=_formula_push, args=(")",))
+    c7.button("←", key="btn_back", on_click=_formula_back)
+    c8.button("C", key="btn_clr", on_click=_formula_clear)
+        
+    st.divider()
+    new_name = st.text_input("公式命名 (例如: 淨利率)")
+    if st.button("💾 儲存自定義比率", use_container_width=True):
+        if new_name and st.session_state.formula_buffer:
+            try:
+                compile_formula(st.session_state.formula_buffer.strip())
+                portfolio.save_ratio(new_name, st.session_state.formula_buffer.strip())
+                st.session_state.formula_buffer = "" 
+                st.rerun()  # 已存公式會出現在分析面板的選項中
+            except FormulaError as e: st.error(f"公式錯誤: {e}")
+            
+    if st.session_state.db["custom_ratios"]:
+        st.caption("已存公式：")
+        for k, v in st.session_state.db["custom_ratios"].items():
+            st.caption(f"• {k}: `{v}`")
+
 with st.sidebar:
     st.title("控制中心")
     with st.expander("🔍 查詢設定", expanded=True):
         market_type = st.radio("選取市場", ["台股", "美股"], horizontal=True)
         main_id = st.text_input("輸入代號", value="2330").upper()
+        live_mode = st.toggle("即時模式 (今日)", help=f"每 {LIVE_POLL_SECONDS:g} 秒只更新最新的K棒" + (f"，來源 {QUOTE_FEED}" if QUOTE_FEED else ""))
 
     with st.expander("📁 資料夾編輯", expanded=True):
-        for fn in list(st.session_state.db["watchlists"].keys()):
-            icon = "📂" if st.session_state.active_folder == fn else "📁"
-            if st.button(f"{icon} {fn}", key=f"f_{fn}"):
-                st.session_state.active_folder = fn; st.rerun()
-            if st.session_state.active_folder == fn:
-                for s in st.session_state.db["watchlists"][fn]: st.write(f"&nbsp;&nbsp;&nbsp;&nbsp;📄 `{s}`")
-        
-        st.divider()
-        st.write("**股票管理**")
-        if st.button(f"加入 {main_id}", use_container_width=True):
-            if st.session_state.active_folder:
-                if main_id not in st.session_state.db["watchlists"][st.session_state.active_folder]:
-                    st.session_state.db["watchlists"][st.session_state.active_folder].append(main_id)
-                    save_db(); st.rerun()
-            else: st.warning("請先選擇一個資料夾")
-
-        if st.button(f"移除 {main_id}", use_container_width=True):
-            if st.session_state.active_folder:
-                if main_id in st.session_state.db["watchlists"][st.session_state.active_folder]:
-                    st.session_state.db["watchlists"][st.session_state.active_folder].remove(main_id)
-                    save_db(); st.rerun()
-            else: st.warning("請先選擇一個資料夾")
-            
-        st.divider()
-        st.write("**資料夾管理**")
-        new_folder_name = st.text_input("新資料夾名稱", placeholder="輸入名稱...", label_visibility="collapsed")
-        if st.button("✨ 建立新資料夾", use_container_width=True):
-            if new_folder_name and new_folder_name not in st.session_state.db["watchlists"]:
-                st.session_state.db["watchlists"][new_folder_name] = []
-                save_db(); st.rerun()
-        
-        if st.button("🗑️ 刪除選中資料夾", use_container_width=True):
-            if st.session_state.active_folder:
-                del st.session_state.db["watchlists"][st.session_state.active_folder]
-                st.session_state.active_folder = None
-                save_db(); st.rerun()
+        folder_editor(main_id)
 
     with st.expander("自定義財務公式", expanded=False):
-        st.write("目前公式:")
-        st.info(st.session_state.formula_buffer if st.session_state.formula_buffer else "(空)")
-        sel_item = st.selectbox("選擇財報科目", list(US_STD_ORDER.keys()), label_visibility="collapsed")
-        if st.button("加入科目", use_container_width=True):
-            st.session_state.formula_buffer += f"{sel_item} "
-            st.rerun()
-            
-        c1, c2, c3, c4 = st.columns(4)
-        if c1.button("＋", key="btn_add"): st.session_state.formula_buffer += "+ "; st.rerun()
-        if c2.button("−", key="btn_sub"): st.session_state.formula_buffer += "- "; st.rerun()
-        if c3.button("×", key="btn_mul"): st.session_state.formula_buffer += "* "; st.rerun()
-        if c4.button("÷", key="btn_div"): st.session_state.formula_buffer += "/ "; st.rerun()
-        
-        c5, c6, c7, c8 = st.columns(4)
-        if c5.button("(", key="btn_p1"): st.session_state.formula_buffer += "( "; st.rerun()
-        if c6.button(")", key="btn_p2"): st.session_state.formula_buffer += ") "; st.rerun()
-        if c7.button("←", key="btn_back"): 
-            st.session_state.formula_buffer = st.session_state.formula_buffer.strip().rsplit(' ', 1)[0] + ' ' if ' ' in st.session_state.formula_buffer.strip() else ""
-            st.rerun()
-        if c8.button("C", key="btn_clr"): 
-            st.session_state.formula_buffer = ""
-            st.rerun()
-            
-        st.divider()
-        new_name = st.text_input("公式命名 (例如: 淨利率)")
-        if st.button("💾 儲存自定義比率", use_container_width=True):
-            if new_name and st.session_state.formula_buffer:
-                st.session_state.db["custom_ratios"][new_name] = st.session_state.formula_buffer.strip()
-                save_db()
-                st.session_state.formula_buffer = "" 
-                st.rerun()
-                
-        if st.session_state.db["custom_ratios"]:
-            st.caption("已存公式：")
-            for k, v in st.session_state.db["custom_ratios"].items():
-                st.caption(f"• {k}: `{v}`")
-
-    view_option = st.radio("深度分析 (左下角)", ["同業對比", "歷年趨勢", "三大法人/機構持有"])
+        formula_builder()
+
+    view_option = st.radio("深度分析 (左下角)", ["同業對比", "歷年趨勢", "三大法人/機構持有", "篩選器"], key="view_option")
     # [新增] API 金鑰設定 (建議放在 st.secrets 中，這裡提供手動輸入框作為備案)
 
     st.divider()
     st.write("🔑 **AI 配置**")
     api_key = st.text_input("輸入 OpenAI API Key", type="password")
-    client = OpenAI(api_key=api_key) if api_key else None
+    client = get_openai_client(api_key) if api_key else None
 
 # --- 4. 主畫面佈局 ---
-l_col, r_col = st.columns([2, 1])
-up_color, down_color, cur_label = ("#FF3333", "#00AA00", "NT$") if market_type == "台股" else ("#00AA00", "#FF3333", "US$")
+def current_price_frame(main_id, market_type):
+    """依行情片段存在 session_state 的尺度與指標取行情，與圖表共用同一快取鍵。"""
+    sel_ind = st.session_state.get("sel_ind", [MA_LABEL])
+    # 均線固定計算，不列入快取鍵，與背景預取共用同一份快取
+    return get_price_data(main_id, st.session_state.get("t_scale", "今日"), market_type, tuple(l for l in sel_ind if l != MA_LABEL))
 
-# === 左欄 ===
-with l_col:
-    st.subheader(f"▍{main_id} 行情")
-    c_type = st.selectbox("類型", ["K線圖", "折線圖"], label_visibility="collapsed")
-    t_scale = st.select_slider("尺度", options=["今日", "5日", "1月", "1年", "5年"], value="今日")
-    hist = get_price_data(main_id, t_scale, market_type)
-    
-    if not hist.empty and 'Close' in hist.columns:
-        # [精細化K線：Subplot + 均線]
-        fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_width=[0.2, 0.8])
-        baseline = hist['Open'].iloc[0]
-        if c_type == "折線圖":
-            add_baseline_line(fig, hist, baseline, up_color, down_color, row=1, col=1)
-            fig.add_hline(y=baseline, line_dash="dash", line_color="gray", line_width=1, row=1, col=1)
+def chart_panel(main_id, market_type, live):
+    from plotly.subplots import make_subplots
+    up_color, down_color, cur_label = MARKET_COLORS[market_type]
+    with perf_span("chart"):
+        st.subheader(f"▍{main_id} 行情")
+        c_type = st.selectbox("類型", ["K線圖", "折線圖"], label_visibility="collapsed")
+        t_scale = st.select_slider("尺度", options=["今日", "5日", "1月", "1年", "5年"], value="今日", key="t_scale")
+        decimate = st.checkbox(f"精簡繪圖 (上限 {MAX_CHART_POINTS} 點)", value=True)
+        sel_ind = st.multiselect("技術指標", list(INDICATOR_MENU), default=[MA_LABEL], key="sel_ind")
+        if live and t_scale == "今日":
+            hist = live_price_frame(main_id, market_type, tuple(l for l in sel_ind if l != MA_LABEL))
         else:
-            fig.add_trace(go.Candlestick(
-                x=hist['Date'], open=hist['Open'], high=hist['High'], low=hist['Low'], close=hist['Close'],
-                increasing_line_color=up_color, decreasing_line_color=down_color,
-                increasing_fillcolor=up_color, decreasing_fillcolor=down_color, name="K線"
-            ), row=1, col=1)
-            # 疊加均線
-            fig.add_trace(go.Scatter(x=hist['Date'], y=hist['MA20'], line=dict(color='#FFA500', width=1), name="月線(MA20)"), row=1, col=1)
-            fig.add_trace(go.Scatter(x=hist['Date'], y=hist['MA60'], line=dict(color='#008000', width=1), name="季線(MA60)"), row=1, col=1)
-            fig.add_trace(go.Scatter(x=hist['Date'], y=hist['MA250'], line=dict(color='#800080', width=1.2), name="年線(MA250)"), row=1, col=1)
-        
-        # 成交量
-        vol_colors = [up_color if c >= o else down_color for o, c in zip(hist['Open'], hist['Close'])]
-        fig.add_trace(go.Bar(x=hist['Date'], y=hist['Volume'], marker_color=vol_colors, name="成交量"), row=2, col=1)
+            st.session_state.pop("live", None)  # 離開即時模式後下次重新由倉儲載入
+            hist = current_price_frame(main_id, market_type)
+    
+        if not hist.empty and 'Close' in hist.columns:
+            # [精細化K線：Subplot + 指標]
+            with get_metrics().span("plotly.price_chart"):
+                osc = [l for l in OSCILLATOR_MENU if l in sel_ind]
+                n_rows = 2 + len(osc)
+                fig = make_subplots(rows=n_rows, cols=1, shared_xaxes=True, vertical_spacing=0.03, row_heights=[0.8 - 0.15 * len(osc)] + [0.15] * len(osc) + [0.2])
+                baseline = hist['Open'].iloc[0]
+                plot_df = downsample_ohlc(hist) if decimate else hist
+                if c_type == "折線圖":
+                    line_df = hist.iloc[lttb_indices(hist['Close'].to_numpy(dtype=float))] if decimate else hist
+                    add_baseline_line(fig, line_df, baseline, up_color, down_color, row=1, col=1)
+                    fig.add_hline(y=baseline, line_dash="dash", line_color="gray", line_width=1, row=1, col=1)
+                else:
+                    fig.add_trace(go.Candlestick(
+                        x=plot_df['Date'], open=plot_df['Open'], high=plot_df['High'], low=plot_df['Low'], close=plot_df['Close'],
+                        increasing_line_color=up_color, decreasing_line_color=down_color,
+                        increasing_fillcolor=up_color, decreasing_fillcolor=down_color, name="K線"
+                    ), row=1, col=1)
+                    # 疊加均線與其他主圖指標
+                    if MA_LABEL in sel_ind:
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA20'], line=dict(color='#FFA500', width=1), name="月線(MA20)"), row=1, col=1)
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA60'], line=dict(color='#008000', width=1), name="季線(MA60)"), row=1, col=1)
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MA250'], line=dict(color='#800080', width=1.2), name="年線(MA250)"), row=1, col=1)
+                    if "EMA (12/26)" in sel_ind:
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['EMA12'], line=dict(color='#1E90FF', width=1), name="EMA12"), row=1, col=1)
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['EMA26'], line=dict(color='#00008B', width=1), name="EMA26"), row=1, col=1)
+                    if "布林通道 (20, 2σ)" in sel_ind:
+                        for c_name, dash in (("BB_upper", "dot"), ("BB_mid", "solid"), ("BB_lower", "dot")):
+                            fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df[c_name], line=dict(color='#708090', width=1, dash=dash), name=c_name), row=1, col=1)
+                    if "VWAP" in sel_ind:
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['VWAP'], line=dict(color='#DAA520', width=1.2), name="VWAP"), row=1, col=1)
+
+                # 副圖指標
+                for r, label in enumerate(osc, start=2):
+                    if label == "RSI (14)":
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['RSI'], line=dict(color='#8A2BE2', width=1), name="RSI"), row=r, col=1)
+                        for lvl in (30, 70): fig.add_hline(y=lvl, line_dash="dot", line_color="gray", line_width=1, row=r, col=1)
+                    elif label == "MACD (12/26/9)":
+                        fig.add_trace(go.Bar(x=plot_df['Date'], y=plot_df['MACD_hist'], marker_color=np.where(plot_df['MACD_hist'] >= 0, up_color, down_color), name="MACD 柱"), row=r, col=1)
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MACD'], line=dict(color='#1E90FF', width=1), name="MACD"), row=r, col=1)
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['MACD_signal'], line=dict(color='#FFA500', width=1), name="Signal"), row=r, col=1)
+                    else:
+                        fig.add_trace(go.Scatter(x=plot_df['Date'], y=plot_df['ATR'], line=dict(color='#A0522D', width=1), name="ATR"), row=r, col=1)
+
+                # 成交量
+                vol_colors = np.where(plot_df['Close'] >= plot_df['Open'], up_color, down_color)
+                fig.add_trace(go.Bar(x=plot_df['Date'], y=plot_df['Volume'], marker_color=vol_colors, name="成交量"), row=n_rows, col=1)
         
-        breaks = [dict(bounds=["sat", "mon"])] 
-        if t_scale in ["今日", "5日", "1月"]:
-            if market_type == "台股": breaks.append(dict(bounds=[13.5, 9], pattern="hour"))
-            else: breaks.append(dict(bounds=[16, 9.5], pattern="hour"))
+                breaks = [dict(bounds=["sat", "mon"])] 
+                if t_scale in ["今日", "5日", "1月"]:
+                    if market_type == "台股": breaks.append(dict(bounds=[13.5, 9], pattern="hour"))
+                    else: breaks.append(dict(bounds=[16, 9.5], pattern="hour"))
         
-        fig.update_xaxes(rangebreaks=breaks)
-        fig.update_layout(height=450, xaxis_rangeslider_visible=False, template="plotly_white", margin=dict(t=0,b=0), yaxis=dict(title=cur_label))
-        st.plotly_chart(fig, use_container_width=True)
-
-        # [行情詳情：五檔報價]
-        with st.expander("📊 查看五檔報價詳情 (Order Book)"):
-            cp = hist['Close'].iloc[-1]
-            c1, c2 = st.columns(2)
-            bid_df = pd.DataFrame({'買入價': [round(cp-0.05*i, 2) for i in range(1,6)], '量': [150, 320, 410, 220, 180]})
-            ask_df = pd.DataFrame({'賣出價': [round(cp+0.05*i, 2) for i in range(1,6)], '量': [90, 210, 180, 350, 420]})
-            c1.dataframe(bid_df, hide_index=True, use_container_width=True)
-            c2.dataframe(ask_df, hide_index=True, use_container_width=True)
-    else:
-        st.error("無法獲取行情，請確認代號。")
+                fig.update_xaxes(rangebreaks=breaks)
+                fig.update_layout(height=450 + 120 * len(osc), xaxis_rangeslider_visible=False, template="plotly_white", margin=dict(t=0,b=0), yaxis=dict(title=cur_label),
+                                  uirevision=f"{main_id}-{t_scale}")  # 即時更新時保留使用者的縮放/平移
+                st.plotly_chart(fig, use_container_width=True)
 
-    st.divider()
+            # [行情詳情：五檔報價]
+            with st.expander("📊 查看五檔報價詳情 (Order Book)"):
+                cp = hist['Close'].iloc[-1]
+                c1, c2 = st.columns(2)
+                bid_df = pd.DataFrame({'買入價': [round(cp-0.05*i, 2) for i in range(1,6)], '量': [150, 320, 410, 220, 180]})
+                ask_df = pd.DataFrame({'賣出價': [round(cp+0.05*i, 2) for i in range(1,6)], '量': [90, 210, 180, 350, 420]})
+                c1.dataframe(bid_df, hide_index=True, use_container_width=True)
+                c2.dataframe(ask_df, hide_index=True, use_container_width=True)
+        else:
+            st.error("無法獲取行情，請確認代號。")
 
-    # 左下分析面板
-    if view_option == "歷年趨勢":
-        st.subheader("歷年趨勢")
-        trend_options = list(US_STD_ORDER.keys()) + list(st.session_state.db["custom_ratios"].keys())
-        sel_t = st.multiselect("比率", trend_options, default=["Total Revenue"])
-        df_f = get_financial_data(main_id, market_type)
-        if not df_f.empty and sel_t:
-            fig_t = go.Figure()
-            piv = df_f.pivot_table(index='date', columns='type', values='value').sort_index()
-            for m in sel_t:
-                if m in st.session_state.db["custom_ratios"]:
-                    res = calculate_custom_formula(st.session_state.db["custom_ratios"][m], piv)
-                    if not isinstance(res, pd.Series) or res.empty: continue
-                    fig_t.add_trace(go.Scatter(x=res.index, y=res, name=m))
-                elif m in piv.columns:
-                    fig_t.add_trace(go.Scatter(x=piv.index, y=piv[m], name=m))
-            st.plotly_chart(fig_t, use_container_width=True)
+@st.fragment
+def analysis_panel(main_id, market_type, view_option):
+    with perf_span("analysis"):
+        # 左下分析面板
+        if view_option == "歷年趨勢":
+            st.subheader("歷年趨勢")
+            trend_options = list(US_STD_ORDER.keys()) + list(st.session_state.db["custom_ratios"].keys())
+            sel_t = st.multiselect("比率", trend_options, default=["Total Revenue"])
+            piv = get_financial_wide(main_id, market_type)
+            if not piv.empty and sel_t:
+                fig_t = go.Figure()
+                for m in sel_t:
+                    if m in st.session_state.db["custom_ratios"]:
+                        try: res = calculate_custom_formula(st.session_state.db["custom_ratios"][m], piv)
+                        except FormulaError as e:
+                            st.warning(f"公式錯誤 {m}: {e}"); continue
+                        if res.empty: continue
+                        fig_t.add_trace(go.Scatter(x=res.index, y=res, name=m))
+                    elif m in piv.columns:
+                        fig_t.add_trace(go.Scatter(x=piv.index, y=piv[m], name=m))
+                st.plotly_chart(fig_t, use_container_width=True)
             
-    elif view_option == "同業對比":
-        st.subheader("同業對比")
-        full_options = list(US_STD_ORDER.keys()) + list(st.session_state.db["custom_ratios"].keys()) + list(YF_RATIOS.keys())
-        sel_c = st.multiselect("指標", full_options, default=["本益比 (PE, Trailing)"])
-        if st.session_state.active_folder:
-            peers = st.session_state.db["watchlists"].get(st.session_state.active_folder, [])
-            all_d = []
-            for sid in peers:
-                m_t = "台股" if sid.isdigit() else "美股"
-                df_p = get_financial_data(sid, m_t)
-                s_info = yf.Ticker(f"{sid}.TW" if m_t=="台股" else sid).info
-                row = {"代號": sid}
-                p_piv = df_p.pivot_table(index='date', columns='type', values='value').sort_index() if not df_p.empty else pd.DataFrame()
-                for m in sel_c:
-                    val = 0
-                    if m in YF_RATIOS:
-                        raw = s_info.get(YF_RATIOS[m], 0)
-                        val = raw * 100 if raw and YF_RATIOS[m] in PERCENTAGE_FIELDS else (raw or 0)
-                    elif m in st.session_state.db["custom_ratios"] and not p_piv.empty:
-                        res = calculate_custom_formula(st.session_state.db["custom_ratios"][m], p_piv)
-                        val = res.iloc[-1] if not res.empty else 0
-                    elif not p_piv.empty and m in p_piv.columns:
-                        val = p_piv[m].iloc[-1]
-                    row[m] = val
-                all_d.append(row)
-            if all_d: 
-                df_chart = pd.DataFrame(all_d).melt(id_vars="代號")
-                st.plotly_chart(px.bar(df_chart, x="代號", y="value", color="variable", barmode="group", template="plotly_white"), use_container_width=True)
-        else: st.info("請先選擇資料夾")
-
-    elif view_option == "三大法人/機構持有":
-        if market_type == "台股":
-            st.subheader("台股三大法人買賣超 (淨額)")
-            try:
-                clean_id = "".join(filter(str.isdigit, main_id))
-                df_chip = api.taiwan_stock_institutional_investors(stock_id=clean_id, start_date=(datetime.now()-timedelta(days=40)).strftime('%Y-%m-%d'))
-                if not df_chip.empty:
-                    df_chip['net'] = df_chip['buy'] - df_chip['sell']
-                    fig_chip = px.bar(df_chip, x='date', y='net', color='name', barmode='group')
-                    max_abs = df_chip['net'].abs().max() * 1.1
-                    fig_chip.update_layout(yaxis_range=[-max_abs, max_abs], template="plotly_white")
-                    st.plotly_chart(fig_chip, use_container_width=True)
+        elif view_option == "同業對比":
+            st.subheader("同業對比")
+            full_options = list(US_STD_ORDER.keys()) + list(st.session_state.db["custom_ratios"].keys()) + list(YF_RATIOS.keys())
+            sel_c = st.multiselect("指標", full_options, default=["本益比 (PE, Trailing)"])
+            if st.session_state.active_folder:
+                import plotly.express as px  # 只有用到的檢視才載入
+                peers = st.session_state.db["watchlists"].get(st.session_state.active_folder, [])
+                chart_slot, status_slot = st.empty(), st.empty()
+                wides, infos, failed, last_draw, errors, n_draws = {}, {}, [], 0.0, [], 0
+
+                def draw_peer_chart(n):
+                    # 每次重繪給不同 key，內容相同的圖重繪兩次才不會觸發重複元件 ID
+                    latest = cube_latest(stack_financial_cube(wides))
+                    table, errs = build_peer_table(latest, {p: infos[p] for p in peers if p in infos}, sel_c, st.session_state.db["custom_ratios"])
+                    chart_slot.plotly_chart(px.bar(table.melt(id_vars="代號"), x="代號", y="value", color="variable", barmode="group", template="plotly_white"),
+                                            use_container_width=True, key=f"peer_chart_{n}")
+                    return errs
+
+                for sid, wide, s_info in stream_peer_snapshots(peers):
+                    if wide is None: failed.append(sid)
+                    else: wides[sid], infos[sid] = wide, s_info
+                    status_slot.caption(f"載入中... {len(infos) + len(failed)}/{len(peers)}")
+                    # 部分結果即時更新長條圖 (節流避免重繪過於頻繁)
+                    if infos and time.time() - last_draw > 0.5:
+                        draw_peer_chart(n_draws); last_draw, n_draws = time.time(), n_draws + 1
+                if infos: errors = draw_peer_chart(n_draws)
+                status_slot.caption(f"⚠ 逾時或抓取失敗: {', '.join(failed)}" if failed else "")
+                for err in errors: st.warning(f"公式錯誤 {err}")
+
+                st.write("**股價表現 (重設基期報酬 %)**")
+                p_scale = st.radio("期間", list(PEER_PRICE_SCALES), index=1, horizontal=True, key="peer_scale")
+                rets = get_peer_returns(tuple(peers), p_scale)
+                if not rets.empty:
+                    fig_r = px.line(rets, template="plotly_white")
+                    fig_r.update_layout(yaxis_title="%", legend_title="代號", xaxis_title=None)
+                    st.plotly_chart(fig_r, use_container_width=True)
+                elif peers: st.caption("暫無股價資料")
+            else: st.info("請先選擇資料夾")
+
+        elif view_option == "三大法人/機構持有":
+            if market_type == "台股":
+                import plotly.express as px
+                st.subheader("台股三大法人買賣超 (淨額)")
+                lookback = st.select_slider("區間 (日曆天)", options=[20, 40, 60, 120, 250, 500], value=INST_DEFAULT_DAYS, key="inst_days")
+                lots = lambda v: "—" if pd.isna(v) else f"{v / 1000:+,.0f} 張"
+                try:
+                    df_chip = get_institutional_data(main_id, lookback)
+                    if not df_chip.empty:
+                        df_chip['net'] = df_chip['buy'] - df_chip['sell']
+                        fig_chip = px.bar(df_chip, x='date', y='net', color='name', barmode='group')
+                        max_abs = df_chip['net'].abs().max() * 1.1
+                        fig_chip.update_layout(yaxis_range=[-max_abs, max_abs], template="plotly_white")
+                        st.plotly_chart(fig_chip, use_container_width=True)
                     
-                    # [法人明細詳情]
-                    with st.expander("📅 三大法人每日淨進出明細 (由近到遠)"):
-                        detail = df_chip.pivot_table(index='date', columns='name', values='net', aggfunc='sum').sort_index(ascending=False)
-                        st.dataframe(detail.style.applymap(lambda v: f'color: {"#FF3333" if v>0 else "#00AA00"}; font-weight:bold'), use_container_width=True)
-            except: st.error("法人數據抓取失敗")
-        else:
-            st.subheader("美股機構持有")
-            try:
-                holders = yf.Ticker(main_id).institutional_holders
-                if holders is not None: st.dataframe(holders, use_container_width=True)
-            except: st.info("暫無資料")
+                        # [法人明細詳情]
+                        with st.expander("📅 三大法人每日淨進出明細 (由近到遠)"):
+                            detail = df_chip.pivot_table(index='date', columns='name', values='net', aggfunc='sum', observed=True).sort_index(ascending=False)
+                            st.dataframe(detail.style.applymap(lambda v: f'color: {"#FF3333" if v>0 else "#00AA00"}; font-weight:bold'), use_container_width=True)
 
-# === 右欄 ===
-with r_col:
-    st.subheader("數據摘要")
-    try:
-        s_sym = f"{main_id}.TW" if (market_type=="台股" or main_id.isdigit()) else main_id
-        ticker_obj = yf.Ticker(s_sym)
-        info = ticker_obj.info
-        curr_p = info.get('currentPrice') or info.get('regularMarketPrice') or (hist['Close'].iloc[-1] if not hist.empty else 0)
-        
-        m1, m2 = st.columns(2)
-        m1.metric("現價", f"{cur_label} {curr_p:,.2f}")
-        m1.metric("EPS", f"${info.get('trailingEps', 0):.2f}")
-        m2.metric("本益比", f"{info.get('trailingPE', 0):.2f}")
-        m2.metric("股利", f"${info.get('lastDividendValue', 0):.2f}")
-    except: st.caption("載入中...")
+                    # [法人彙總] 讀取預先算好的累積淨額與外資動向
+                    flow = get_institutional_flow(main_id, lookback)
+                    if not flow.empty:
+                        last = flow.iloc[-1]
+                        k1, k2, k3, k4, k5 = st.columns(5)
+                        k1.metric("5日累積", lots(last['cum5']))
+                        k2.metric("20日累積", lots(last['cum20']))
+                        k3.metric("60日累積", lots(last['cum60']))
+                        streak = 0 if pd.isna(last['foreign_streak']) else int(last['foreign_streak'])
+                        k4.metric("外資", f"連{'買' if streak > 0 else '賣'} {abs(streak)} 日" if streak else "—")
+                        k5.metric("外資/成交量", "—" if pd.isna(last['foreign_pct']) else f"{last['foreign_pct']:+.1f}%")
+                        with st.expander("📈 累積淨額走勢"):
+                            st.plotly_chart(px.line(flow, x='date', y=[f'cum{n}' for n in INST_WINDOWS], template="plotly_white"), use_container_width=True)
 
-    st.divider()
-    st.subheader("財務報表")
-    df_raw = get_financial_data(main_id, market_type)
-    if not df_raw.empty:
-        df_p = df_raw.pivot_table(index='type', columns='date', values='value').sort_index(axis=1, ascending=False)
-        sorted_idx = sorted(df_p.index, key=lambda x: US_STD_ORDER.get(x, 999))
-        st.dataframe(df_p.reindex(sorted_idx), height=500, use_container_width=True)
+                    if st.session_state.active_folder:
+                        with st.expander(f"📁 {st.session_state.active_folder} 法人總覽"):
+                            summary = get_institutional_summary(tuple(st.session_state.db["watchlists"].get(st.session_state.active_folder, [])))
+                            if not summary.empty:
+                                view = summary[['date'] + [f'cum{n}' for n in INST_WINDOWS]].copy()
+                                for n in INST_WINDOWS: view[f'cum{n}'] = view[f'cum{n}'].map(lots)
+                                view['外資連續'] = summary['foreign_streak'].fillna(0).astype(int)
+                                view['外資/成交量 %'] = summary['foreign_pct'].round(1)
+                                st.dataframe(view.rename(columns={'date': '日期', 'cum5': '5日累積', 'cum20': '20日累積', 'cum60': '60日累積'}), use_container_width=True)
+                            else: st.caption("資料夾內沒有台股")
+                except: st.error("法人數據抓取失敗")
+            else:
+                st.subheader("美股機構持有")
+                try:
+                    count_upstream("yfinance")
+                    holders = yf.Ticker(main_id).institutional_holders
+                    if holders is not None: st.dataframe(holders, use_container_width=True)
+                except: st.info("暫無資料")
+
+        elif view_option == "篩選器":
+            st.subheader("篩選器")
+            universe_type = st.radio("範圍", ["台股上市", "美股 (上傳清單)"], horizontal=True)
+            if universe_type == "台股上市":
+                try: universe = {sid: ("台股", name) for sid, name in get_tw_universe().items()}
+                except Exception: universe = {}; st.error("台股清單抓取失敗")
+            else:
+                uploaded = st.file_uploader("上傳代號清單 (txt / csv，以逗號或換行分隔)", type=["txt", "csv"])
+                tokens = re.split(r"[\s,;]+", uploaded.getvalue().decode("utf-8", "ignore").upper()) if uploaded else []
+                universe = {t: ("美股", "") for t in tokens if re.fullmatch(r"[A-Z][A-Z.\-]*", t)}
+
+            refresher = get_fundamentals_refresher()
+            c1, c2 = st.columns([1, 2])
+            if c1.button("🔄 背景更新基本面", use_container_width=True, disabled=not universe):
+                refresher.start(universe)
+                st.session_state.scr_refreshing = True
+            with c2: st.fragment(refresh_progress, run_every=SCREENER_POLL_SECONDS if refresher.running else None)(refresher)
+            table = get_fundamentals_table(fundamentals_version())
+            table = table[table.index.isin(list(universe))] if not table.empty else table
+            c2.caption(f"基本面表已涵蓋 {len(table)}/{len(universe)} 檔")
+
+            metric_options = list(YF_RATIOS.keys()) + list(st.session_state.db["custom_ratios"].keys())
+            sel_f = st.multiselect("篩選條件", metric_options, default=["本益比 (PE, Trailing)", "ROE"])
+            conditions = []
+            for m in sel_f:
+                f1, f2, f3 = st.columns([2, 1, 1])
+                f1.write(f"**{m}**")
+                op = f2.selectbox("條件", ["≥", "≤"], key=f"scr_op_{m}", label_visibility="collapsed", index=1 if "本益比" in m else 0)
+                # 未輸入門檻的條件不套用，避免預設值篩掉所有代號
+                threshold = f3.number_input("門檻", key=f"scr_th_{m}", label_visibility="collapsed", value=None, placeholder="未設定")
+                if threshold is not None: conditions.append((m, op, threshold))
+            r1, r2 = st.columns([3, 1])
+            rank_by = r1.selectbox("排序依據", metric_options)
+            ascending = r2.toggle("由小到大", value="本益比" in rank_by)
+            if not table.empty:
+                try:
+                    res = screen_universe(table, conditions, st.session_state.db["custom_ratios"], rank_by, ascending)
+                    st.caption(f"符合 {len(res)} 檔")
+                    st.dataframe(res.drop(columns='market').head(200), use_container_width=True)
+                except FormulaError as e: st.warning(f"公式錯誤: {e}")
+            else: st.info("尚無基本面資料，請先點擊「背景更新基本面」。")
+
+def refresh_progress(refresher):
+    """背景更新進度；以 run_every 片段定時重跑，完成後整頁重跑載入新的基本面表"""
+    if refresher.running:
+        st.progress(refresher.done / max(refresher.total, 1), text=f"更新中 {refresher.done}/{refresher.total} (失敗 {refresher.failed}，順延 {refresher.deferred})")
+    elif st.session_state.pop("scr_refreshing", False):
+        st.rerun()
+    elif refresher.failed or refresher.deferred:
+        st.caption(f"上次更新失敗 {refresher.failed} 檔、順延 {refresher.deferred} 檔 (台股財報配額)，可再次點擊更新")
+
+@st.fragment
+def summary_panel(main_id, market_type):
+    cur_label = MARKET_COLORS[market_type][2]
+    with perf_span("summary"):
+        st.subheader("數據摘要")
+        try:
+            s_sym = f"{main_id}.TW" if (market_type=="台股" or main_id.isdigit()) else main_id
+            info = get_ticker_info(s_sym)
+            curr_p = info.get('currentPrice') or info.get('regularMarketPrice')
+            if not curr_p:
+                hist = current_price_frame(main_id, market_type)
+                curr_p = hist['Close'].iloc[-1] if not hist.empty else 0
         
-    st.divider()
-    st.subheader("🤖 AI 投資助手")
+            m1, m2 = st.columns(2)
+            m1.metric("現價", f"{cur_label} {curr_p:,.2f}")
+            m1.metric("EPS", f"${info.get('trailingEps', 0):.2f}")
+            m2.metric("本益比", f"{info.get('trailingPE', 0):.2f}")
+            m2.metric("股利", f"${info.get('lastDividendValue', 0):.2f}")
+        except: st.caption("載入中...")
+
+@st.fragment
+def statements_panel(main_id, market_type):
+    with perf_span("statements"):
+        st.subheader("財務報表")
+        wide = get_financial_wide(main_id, market_type)
+        if not wide.empty:
+            df_p = wide.T.sort_index(axis=1, ascending=False)
+            sorted_idx = sorted(df_p.index, key=lambda x: US_STD_ORDER.get(x, 999))
+            st.dataframe(df_p.reindex(sorted_idx), height=500, use_container_width=True)
+
+@st.fragment
+def ai_panel(main_id, market_type, client):
+    with perf_span("ai"):
+        st.subheader("🤖 AI 投資助手")
+        assistant = get_ai_assistant()
+        model = OpenAIChatModel(client, AI_MODEL) if client and AI_BACKEND != "local" else LocalChatModel()
     
-    # 自動生成當前狀態背景
-    if not hist.empty:
-        ma60_val = hist['MA60'].iloc[-1]
-        trend_status = "站在季線上方 (多頭趨勢)" if cp > ma60_val else "位居季線下方 (空頭趨勢)"
-        context_prompt = f"當前股票: {main_id}, 現價: {cp}, {trend_status}。請提供投資建議。"
-        
-        # 對話顯示區
-        chat_container = st.container(height=250)
-        with chat_container:
-            st.markdown('<div class="ai-chat-box">', unsafe_allow_html=True)
-            if not st.session_state.chat_history:
-                st.write(f"**系統提示:** 偵測到 {main_id}。{trend_status}。您可以開始詢問具體策略。")
-            for msg in st.session_state.chat_history:
-                with st.chat_message(msg["role"]):
-                    st.markdown(msg["content"])
-            st.markdown('</div>', unsafe_allow_html=True)
-
-        # 對話輸入
-        if not client:
-            st.warning("若需要使用模型，在左方側邊欄輸入OpenAI API Key即可啟動對話。")
-            user_input = st.text_input("輸入您的問題 (例如: 支撐位在哪?)...", key="chat_input")
-            if st.button("發送詢問", use_container_width=True):
-                if user_input:
-                    st.session_state.chat_history.append({"role": "user", "content": user_input})
-                    # 模擬 AI 回應 (實務上可對接 OpenAI/Gemini API)
-                    ai_reply = f"根據檢索，{main_id} 目前{trend_status}。技術面上，短線支撐約在 {round(cp*0.95, 2)} 附近。考量到當前市場波動，建議分批佈局。"
-                st.session_state.chat_history.append({"role": "assistant", "content": ai_reply})
-                st.rerun()
-        else:
+        # 當前狀態背景 (同一檔多次提問共用同一份摘要)
+        digest = assistant.digest(main_id, market_type)
+        if digest:
+            # 對話顯示區
+            chat_container = st.container(height=250)
+            with chat_container:
+                st.markdown('<div class="ai-chat-box">', unsafe_allow_html=True)
+                if not st.session_state.chat_history:
+                    st.write(f"**系統提示:** 偵測到 {main_id}。{digest['trend']}。您可以開始詢問具體策略。")
+                for msg in st.session_state.chat_history:
+                    with st.chat_message(msg["role"]):
+                        st.markdown(msg["content"])
+                st.markdown('</div>', unsafe_allow_html=True)
+
+            # 對話輸入
+            if not client:
+                st.warning("若需要使用模型，在左方側邊欄輸入OpenAI API Key即可啟動對話。")
             user_input = st.text_input("詢問 AI 關於這檔股票...", key="chat_input")
             if st.button("發送詢問", use_container_width=True):
                 if user_input:
-                    context = f"當前標的: {main_id}, 現價: {curr_p}, 季線(MA60): {ma60_val}。投資者問題: {user_input}"
                     st.session_state.chat_history.append({"role": "user", "content": user_input})
                     with st.chat_message("assistant"):
                         message_placeholder = st.empty()
                         full_response = ""
                         try:
-                            response = client.chat.completions.create(
-                                model="gpt-3.5-turbo",
-                                messages=[{"role": "system", "content": context + "你是一位專業的證券分析師。請根據提供的數據, 問題給出具體的投資分析與風險提示。"}, 
-                                {"role": "user", "content": context}],
-                                stream=True
-                            )
-                            for chunk in response:
-                                if chunk.choices[0].delta.content:
-                                    full_response += chunk.choices[0].delta.content
-                                    message_placeholder.markdown(full_response + "▌")
+                            for part in assistant.ask(model, digest, user_input):
+                                full_response += part
+                                message_placeholder.markdown(full_response + "▌")
                             message_placeholder.markdown(full_response)
                             st.session_state.chat_history.append({"role": "assistant", "content": full_response})
-                            st.rerun()
+                            st.rerun(scope="fragment")
                         except Exception as e:
                             st.error(f"API 呼叫失敗: {e}")
-                    
-    
\ No newline at end of file
+
+            # 批次摘要：整個資料夾並行建立，之後對其中任一檔提問不必再整理背景。
+            # 點擊時才讀取目前的資料夾，切換資料夾不必重跑本面板
+            if st.button("📋 產生目前資料夾摘要", use_container_width=True):
+                folder = st.session_state.db["watchlists"].get(st.session_state.active_folder, []) if st.session_state.active_folder else []
+                if not folder: st.info("請先選擇非空的資料夾")
+                for sid, d in assistant.batch_digests(folder).items():
+                    with st.expander(sid): st.text(d["text"] if d else "無法取得資料")
+
+l_col, r_col = st.columns([2, 1])
+
+# === 左欄 ===
+with l_col:
+    # 即時模式下行情片段依 run_every 自行定時重跑，不影響其他面板
+    st.fragment(chart_panel, run_every=LIVE_POLL_SECONDS if live_mode else None)(main_id, market_type, live_mode)
+    st.divider()
+    analysis_panel(main_id, market_type, view_option)
+
+# === 右欄 ===
+with r_col:
+    summary_panel(main_id, market_type)
+    st.divider()
+    statements_panel(main_id, market_type)
+    st.divider()
+    ai_panel(main_id, market_type, client)
+
+# [除錯面板] 網址加上 ?debug=1 才顯示
+if st.query_params.get("debug") == "1":
+    with st.sidebar.expander("🛠 效能統計", expanded=True):
+        metrics = get_metrics()
+        st.write("**計時區段 (全部 session)**")
+        st.dataframe(metrics.span_table(), hide_index=True, use_container_width=True)
+        st.write("**快取命中率**")
+        st.dataframe(metrics.cache_table(), use_container_width=True)
+        st.write("**共用資料快取**")
+        st.json(get_frame_cache().stats())
+        st.write("**上游呼叫次數**")
+        st.json(metrics.upstream_counts())
+        st.download_button("下載 Prometheus 文字格式", metrics.to_prometheus(), file_name="metrics.prom")
+
+st.session_state.perf["rerun"] = time.perf_counter() - _rerun_t0
+get_metrics().observe("rerun", st.session_state.perf["rerun"])
+export_metrics(st.session_state.perf)
@@ -0,0 +1,370 @@
+"""離線效能基準：重播錄製的 yfinance / FinMind 回應，以 Streamlit AppTest 無頭驅動 app.py。
+
+每個情境在乾淨的暫存目錄 (全新 market_data.db / portfolio.db) 下執行一次冷啟動與數次熱重跑，
+回報重跑延遲、各面板耗時 (app.py 的 perf_span) 與記憶體峰值。
+「啟動首屏」另以全新子程序量測從程序啟動到第一次完整執行結束的時間 (含模組載入)。
+
+用法:
+    python bench.py                          # 重播 bench_fixtures/，缺檔時以固定種子產生合成資料
+    python bench.py --record                 # 連網錄製實際回應至 bench_fixtures/
+    python bench.py --scenario 5年K線 --repeat 5
+    python bench.py --scenario 啟動首屏       # 只量測冷啟動首屏
+    python bench.py --save-baseline base.json
+    python bench.py --baseline base.json     # 任一情境比基準慢超過 --tolerance 即以非零代碼結束
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+import pandas as pd
+import yfinance as yf
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+
+US_ITEMS = ["Total Revenue", "Cost of Revenue", "Gross Profit", "Operating Expense", "Operating Income", "Net Income", "Basic EPS"]
+TW_ITEMS = ["Revenue", "CostOfGoodsSold", "GrossProfit", "OperatingExpenses", "OperatingIncome", "NetIncome", "EPS"]
+INFO_FIELDS = ["trailingPE", "forwardPE", "pegRatio", "priceToBook", "priceToSalesTrailing12Months", "enterpriseValueToEbitda",
+               "profitMargins", "grossMargins", "operatingMargins", "returnOnEquity", "returnOnAssets", "currentRatio",
+               "quickRatio", "debtToEquity", "beta", "dividendYield", "payoutRatio", "currentPrice", "trailingEps", "lastDividendValue"]
+PERIOD_DAYS = {"1d": 1, "5d": 5, "1mo": 22, "1y": 252, "2y": 504, "5y": 1260, "7y": 1764}
+BARS_PER_DAY = {"1m": 270, "5m": 54, "60m": 5, "1d": 1}
+
+
+# --- 錄製 / 重播 ---
+
+class Fixtures:
+    def __init__(self, record):
+        self.record = record
+        self.synthetic = 0
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+
+    def path(self, kind, key):
+        return os.path.join(FIXTURE_DIR, f"{kind}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}.pkl")
+
+    def get(self, kind, key, live, synth):
+        path = self.path(kind, key)
+        if self.record:
+            value = live()
+            with open(path, "wb") as f: pickle.dump(value, f)
+            return value
+        if os.path.exists(path):
+            with open(path, "rb") as f: return pickle.load(f)
+        self.synthetic += 1
+        return synth()
+
+
+def _rng(*key):
+    return np.random.default_rng(zlib.crc32(repr(key).encode()))
+
+
+def synth_bars(symbol, interval, period=None, start=None):
+    rng = _rng(symbol, interval)
+    if start is not None:
+        days = pd.bdate_range(pd.Timestamp(start).tz_localize(None).normalize(), pd.Timestamp.now().normalize())
+    else:
+        days = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=PERIOD_DAYS.get(period, 1))
+    per_day = BARS_PER_DAY.get(interval, 1)
+    if interval == "1d":
+        index = days
+    else:
+        step = {"1m": 1, "5m": 5, "60m": 60}[interval]
+        offsets = pd.to_timedelta(np.arange(per_day) * step, unit="min") + pd.Timedelta(hours=1, minutes=30)
+        index = pd.DatetimeIndex((days.values[:, None] + offsets.values[None, :]).ravel()).tz_localize("UTC")
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, len(index))))
+    spread = np.abs(rng.normal(0, 0.005, len(index))) * close
+    return pd.DataFrame({"Open": close + rng.normal(0, 0.3, len(index)), "High": close + spread, "Low": close - spread,
+                         "Close": close, "Volume": rng.integers(1_000, 1_000_000, len(index)).astype(float)}, index=index)
+
+
+def synth_info(symbol):
+    rng = _rng(symbol, "info")
+    return {k: float(rng.uniform(0.05, 40)) for k in INFO_FIELDS}
+
+
+def synth_quarterly(symbol):
+    rng = _rng(symbol, "quarterly")
+    dates = pd.date_range(end=pd.Timestamp.now(), periods=5, freq=pd.offsets.QuarterEnd())
+    return pd.DataFrame(rng.uniform(1e8, 1e10, (len(US_ITEMS), len(dates))), index=US_ITEMS, columns=dates)
+
+
+def synth_tw_financial(stock_id, start_date):
+    rng = _rng(stock_id, "financial")
+    dates = pd.date_range(start_date, pd.Timestamp.now(), freq=pd.offsets.QuarterEnd()).strftime("%Y-%m-%d")
+    rows = [(d, stock_id, t, float(rng.uniform(1e8, 1e10)), t) for d in dates for t in TW_ITEMS]
+    return pd.DataFrame(rows, columns=["date", "stock_id", "type", "value", "origin_name"])
+
+
+def synth_tw_institutional(stock_id, start_date, end_date=None):
+    rng = _rng(stock_id, "institutional", start_date)
+    dates = pd.bdate_range(start_date, end_date or pd.Timestamp.now()).strftime("%Y-%m-%d")
+    names = ["Foreign_Investor", "Investment_Trust", "Dealer_self"]
+    rows = [(d, stock_id, float(rng.integers(0, 5_000_000)), n, float(rng.integers(0, 5_000_000))) for d in dates for n in names]
+    return pd.DataFrame(rows, columns=["date", "stock_id", "buy", "name", "sell"])
+
+
+def install_fakes(fx):
+    """以重播版本取代 app.py 使用的上游呼叫"""
+    install_yf_fakes(fx)
+    install_finmind_fakes(fx)
+
+
+def install_yf_fakes(fx):
+    real_download, real_ticker = yf.download, yf.Ticker
+
+    def download(symbol, interval="1d", period=None, start=None, **kw):
+        if isinstance(symbol, (list, tuple)):
+            # 多檔下載 (group_by="ticker")：逐檔重播後組回 (代號, 欄位) 的 MultiIndex 欄位，與單檔共用錄製檔
+            return pd.concat({s: download(s, interval, period, start) for s in symbol}, axis=1)
+        key = (symbol, interval, period, None if start is None else str(start)[:10])
+        span = {k: v for k, v in (("period", period), ("start", start)) if v is not None}
+        return fx.get("download", key, lambda: real_download(symbol, interval=interval, **span, **kw),
+                      lambda: synth_bars(symbol, interval, period, start))
+
+    class Ticker:
+        def __init__(self, symbol):
+            self.symbol = symbol
+
+        @property
+        def info(self):
+            return fx.get("info", self.symbol, lambda: real_ticker(self.symbol).info, lambda: synth_info(self.symbol))
+
+        @property
+        def quarterly_financials(self):
+            return fx.get("quarterly", self.symbol, lambda: real_ticker(self.symbol).quarterly_financials, lambda: synth_quarterly(self.symbol))
+
+        @property
+        def institutional_holders(self):
+            return fx.get("holders", self.symbol, lambda: real_ticker(self.symbol).institutional_holders, lambda: None)
+
+    yf.download, yf.Ticker = download, Ticker
+
+
+def install_finmind_fakes(fx):
+    # app.py 延後載入 FinMind，此處也在需要時才載入
+    from FinMind.data import DataLoader
+    real_fin, real_inst = DataLoader.taiwan_stock_financial_statement, DataLoader.taiwan_stock_institutional_investors
+
+    def financial(self, stock_id="", start_date="", end_date="", **kw):
+        return fx.get("tw_financial", (stock_id, start_date), lambda: real_fin(self, stock_id=stock_id, start_date=start_date, **kw),
+                      lambda: synth_tw_financial(stock_id, start_date))
+
+    def institutional(self, stock_id="", start_date="", end_date="", **kw):
+        return fx.get("tw_institutional", (stock_id, start_date, end_date), lambda: real_inst(self, stock_id=stock_id, start_date=start_date, end_date=end_date, **kw),
+                      lambda: synth_tw_institutional(stock_id, start_date, end_date or None))
+
+    DataLoader.taiwan_stock_financial_statement = financial
+    DataLoader.taiwan_stock_institutional_investors = institutional
+    if not fx.record:
+        # 建構子與登入都會連網：重播時換成空操作，離線也能建立 FinMindClient
+        DataLoader.__init__ = lambda self, *args, **kw: None
+        DataLoader.login_by_token = lambda self, *args, **kw: None
+
+
+# --- 情境 ---
+
+PEERS_50 = [str(1101 + i * 7) for i in range(25)] + ["AAPL", "MSFT", "NVDA", "TSLA", "GOOGL", "AMZN", "META", "AMD", "INTC", "ORCL",
+                                                       "IBM", "CSCO", "QCOM", "TXN", "AVGO", "ADBE", "CRM", "NFLX", "PYPL", "UBER",
+                                                       "SHOP", "SNOW", "PLTR", "MU", "AMAT"]
+FORMULAS_10 = {
+    "毛利率": "Gross Profit / Total Revenue",
+    "營益率": "Operating Income / Total Revenue",
+    "淨利率": "Net Income / Total Revenue",
+    "成本率": "Cost of Revenue / Total Revenue",
+    "費用率": "Operating Expense / Total Revenue",
+    "營業槓桿": "Operating Income / Gross Profit",
+    "淨利轉換": "Net Income / Operating Income",
+    "費用毛利比": "Operating Expense / Gross Profit",
+    "毛利減費用": "( Gross Profit - Operating Expense ) / Total Revenue",
+    "淨利百分比": "Net Income * 100 / Total Revenue",
+}
+
+SCENARIOS = {
+    "今日K線": dict(scale="今日"),
+    "5年K線": dict(scale="5年"),
+    "5年折線": dict(scale="5年", chart="折線圖"),
+    "同業對比50檔": dict(view="同業對比", folder=PEERS_50, metrics=["本益比 (PE, Trailing)", "ROE", "Total Revenue", "毛利率"]),
+    "歷年趨勢10公式": dict(view="歷年趨勢", trend=list(FORMULAS_10)),
+}
+
+
+STARTUP = "啟動首屏"
+# app.py 延後載入的模組；預設首屏為台股 2330，財報面板需要 FinMind，會列為已載入
+LAZY_MODULES = ["openai", "FinMind", "plotly.express"]
+# 啟動量測的子程序入口：先掛上匯入攔截再交給 AppTest，app.py 匯入 yfinance / FinMind 之後才載入本檔並換上重播版本，
+# 因此 app.py 的模組載入時間 (perf["imports"]) 與延後載入的模組都不受量測工具本身影響
+STARTUP_BOOTSTRAP = """
+import importlib.abc, importlib.util, json, os, sys, tempfile, time
+t_spawn, bench_dir, lazy = float(sys.argv[1]), sys.argv[2], json.loads(sys.argv[3])
+sys.path.insert(0, bench_dir)
+
+class PatchOnImport(importlib.abc.MetaPathFinder):
+    def __init__(self, patches):
+        self.patches = patches
+
+    def find_spec(self, name, path, target=None):
+        if name not in self.patches: return None
+        sys.meta_path.remove(self)
+        try: spec = importlib.util.find_spec(name)
+        finally: sys.meta_path.insert(0, self)
+        exec_module, installer = spec.loader.exec_module, self.patches.pop(name)
+        def exec_and_patch(module):
+            exec_module(module)
+            import bench
+            getattr(bench, installer)(bench.Fixtures(record=False))
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+sys.meta_path.insert(0, PatchOnImport({"yfinance": "install_yf_fakes", "FinMind.data": "install_finmind_fakes"}))
+os.chdir(tempfile.mkdtemp(prefix="bench-"))
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(os.path.join(bench_dir, "app.py"), default_timeout=600)
+t0 = time.perf_counter()
+at.run()
+first_run = time.perf_counter() - t0
+if at.exception: sys.exit(at.exception[0].message)
+print(json.dumps({"first_render_s": time.time() - t_spawn, "first_run_s": first_run,
+                  "imports_s": at.session_state["perf"].get("imports", 0.0),
+                  "loaded": [m for m in lazy if m in sys.modules]}))
+"""
+
+
+def _widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+
+def run_scenario(name, spec, repeat):
+    from streamlit.testing.v1 import AppTest
+    import streamlit as st
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    # 以舊版 JSON 佈置觀察清單與公式，由 app.py 首次執行時匯入
+    with open("portfolio_db.json", "w", encoding="utf-8") as f:
+        json.dump({"watchlists": {"bench": spec.get("folder", ["2330"])}, "custom_ratios": FORMULAS_10}, f, ensure_ascii=False)
+
+    def reset_caches():
+        st.cache_data.clear()
+        st.cache_resource.clear()  # 連同 FrameCache / MarketStore 連線一起丟棄
+        for path in glob.glob("market_data.db*"): os.remove(path)
+
+    reset_caches()
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.session_state["active_folder"] = "bench"
+
+    def configure():
+        # 各分析面板的元件要切換檢視並重跑一次後才存在
+        _widget(at.radio, "深度分析 (左下角)").set_value(spec.get("view", "同業對比"))
+        at.run()
+        if at.exception: raise RuntimeError(f"{name}: {at.exception[0].message}")
+        _widget(at.select_slider, "尺度").set_value(spec.get("scale", "今日"))
+        _widget(at.selectbox, "類型").set_value(spec.get("chart", "K線圖"))
+        if "metrics" in spec: _widget(at.multiselect, "指標").set_value(spec["metrics"])
+        if "trend" in spec: _widget(at.multiselect, "比率").set_value(spec["trend"])
+
+    def timed_run():
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        at.run()
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if at.exception: raise RuntimeError(f"{name}: {at.exception[0].message}")
+        return elapsed, peak, dict(at.session_state["perf"])
+
+    at.run()  # 建立元件後才能設定
+    configure()
+    reset_caches()  # 設定過程的執行已填滿快取，冷啟動須從空的快取與倉儲開始
+    cold = timed_run()
+    warm = [timed_run() for _ in range(repeat)]
+    # 台股財報路徑失敗時各面板只會顯示空表，量測結果沒有意義
+    tw_ids = {"2330"} | ({sid for sid in spec.get("folder", []) if sid.isdigit()} if spec.get("view") == "同業對比" else set())
+    with sqlite3.connect("market_data.db") as conn:
+        loaded = {row[0] for row in conn.execute("SELECT DISTINCT stock_id FROM fm_financial")}
+    if tw_ids - loaded: raise RuntimeError(f"{name}: 未載入台股財報 {', '.join(sorted(tw_ids - loaded))}")
+    return {
+        "cold_s": cold[0],
+        "warm_s": statistics.median(w[0] for w in warm),
+        "peak_mb": max(r[1] for r in [cold] + warm) / 2 ** 20,
+        "panels_cold": cold[2],
+        "panels_warm": {k: statistics.median(w[2].get(k, 0.0) for w in warm) for k in cold[2]},
+    }
+
+
+def run_startup(repeat):
+    runs = []
+    for _ in range(repeat):
+        t_spawn = time.time()
+        out = subprocess.run([sys.executable, "-c", STARTUP_BOOTSTRAP, str(t_spawn), os.path.dirname(APP_PATH), json.dumps(LAZY_MODULES)],
+                             capture_output=True, text=True)
+        if out.returncode: raise RuntimeError(f"{STARTUP}: {out.stderr.strip().splitlines()[-1] if out.stderr.strip() else out.returncode}")
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "first_render_s": statistics.median(r["first_render_s"] for r in runs),
+        "first_run_s": statistics.median(r["first_run_s"] for r in runs),
+        "imports_s": statistics.median(r["imports_s"] for r in runs),
+        "loaded": runs[-1]["loaded"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", action="store_true", help="連網錄製上游回應")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS) + [STARTUP], help="只跑指定情境 (可重複)")
+    parser.add_argument("--repeat", type=int, default=3, help="熱重跑次數 (啟動首屏為子程序次數)")
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出結果")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允許比基準慢的比例")
+    args = parser.parse_args()
+
+    os.environ["PREFETCH_ENABLED"] = "0"  # 背景預取會干擾量測 (子程序繼承此設定)
+    fx = Fixtures(args.record)
+    install_fakes(fx)
+
+    cwd = os.getcwd()
+    results = {}
+    try:
+        for name in args.scenario or list(SCENARIOS) + [STARTUP]:
+            results[name] = run_startup(args.repeat) if name == STARTUP else run_scenario(name, SCENARIOS[name], args.repeat)
+    finally:
+        os.chdir(cwd)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        for name, r in results.items():
+            if name == STARTUP:
+                print(f"▍{name}: 首屏 {r['first_render_s']:.2f}s  (模組載入 {r['imports_s']:.2f}s，首次執行 {r['first_run_s']:.2f}s)  "
+                      f"已載入延後模組: {', '.join(r['loaded']) or '無'}")
+                continue
+            print(f"▍{name}: 冷啟動 {r['cold_s']:.2f}s  熱重跑 {r['warm_s']:.3f}s  記憶體峰值 {r['peak_mb']:.1f} MB")
+            for panel, t in sorted(r["panels_warm"].items(), key=lambda kv: -kv[1]):
+                print(f"    {panel:<12} 冷 {r['panels_cold'][panel]:.3f}s  熱 {t:.3f}s")
+        if fx.synthetic: print(f"(注意: {fx.synthetic} 筆上游回應無錄製檔，使用合成資料)")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: base = json.load(f)
+        key = lambda n: "first_render_s" if n == STARTUP else "warm_s"
+        slow = [f"{n}: {r[key(n)]:.3f}s vs {base[n][key(n)]:.3f}s" for n, r in results.items()
+                if n in base and r[key(n)] > base[n][key(n)] * (1 + args.tolerance)]
+        for line in slow: print(f"⚠ 效能退步 {line}")
+        if slow: sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()